@@ -1,27 +1,113 @@
+import hashlib
+import heapq
+import math
+import os
+import sqlite3
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from datetime import datetime, timedelta
 
 import numpy as np
 import pandas as pd
 import requests
-from binance.client import Client
-from py3cw.request import Py3CW
 from tqdm import tqdm
 from enum import Enum
+from multiprocessing import Pool
 
+import archive
+import metrics
 from config import Config
 
-config = Config()
-p3cw = Py3CW(
-    key=config.tc_key,
-    secret=config.tc_secret,
-    request_options={
-        "request_timeout": 10,
-        "nr_of_retries": 1,
-        "retry_status_codes": [502],
-    },
-)
+config = None
+p3cw = None
+# 3Commas requests in flight at once, one pooled connection each
+tcWorkers = 8
+tcRetries = 4
+tcBackoff = 0.5
+tcSlots = threading.BoundedSemaphore(tcWorkers)
+p3cwLock = threading.Lock()
+
+
+def getConfig():
+    global config
+    if config is None:
+        config = Config()
+    return config
+
+
+def getP3cw():
+    """3Commas client, created on first use"""
+    global p3cw
+    with p3cwLock:
+        if p3cw is None:
+            p3cw = archive.wrap("3commas", makeP3cw)
+    return p3cw
+
+
+def makeP3cw():
+    from py3cw.request import Py3CW
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    client = Py3CW(
+        key=getConfig().tc_key,
+        secret=getConfig().tc_secret,
+        request_options={
+            "request_timeout": 10,
+            "nr_of_retries": 1,
+            "retry_status_codes": [502],
+        },
+    )
+    client.session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_maxsize=tcWorkers,
+            max_retries=Retry(
+                total=client.request_retries_count,
+                backoff_factor=client.request_retry_backoff_factor,
+                status_forcelist=client.request_retry_status_codes,
+            ),
+        ),
+    )
+    return metrics.instrument("3commas", client)
+
+
+def request(entity, action="", action_id=None, payload=None):
+    """p3cw.request over the shared pool, retrying server and connection
+    errors with exponential backoff"""
+    for attempt in range(tcRetries + 1):
+        if attempt:
+            time.sleep(tcBackoff * 2 ** (attempt - 1))
+        with tcSlots:
+            metrics.setRetry(attempt > 0)
+            resp = getP3cw().request(
+                entity=entity, action=action, action_id=action_id, payload=payload
+            )
+            metrics.setRetry(False)
+        status = resp[0].get("status_code")
+        if len(resp[0]) == 0 or (status is not None and status < 500 and status != 429):
+            break
+    return resp
+
+
+def fanOut(function, args):
+    """function applied to every arg concurrently, results in order"""
+    args = list(args)
+    if len(args) < 2:
+        return [function(arg) for arg in args]
+    with ThreadPoolExecutor(max_workers=min(len(args), tcWorkers)) as executor:
+        return list(executor.map(function, args))
+
+
+def postDiscord(content):
+    """Posts to the configured webhook, replays stay off the network"""
+    if archive.replaying():
+        print(content)
+        return
+    requests.post(getConfig().discordHook, {"content": content})
 
 
 def cmpFloat(a, b):
@@ -134,133 +220,551 @@ def printSafetys(
     print(df)
 
 
+def printRunnersUp(settings):
+    df = pd.DataFrame(
+        settings,
+        columns=[
+            "Base Order",
+            "Safety Order",
+            "Max Safetys",
+            "Volume Scale",
+            "$ / bot",
+            "Step",
+            "Step Scale",
+            "Lowest TP %",
+        ],
+    )
+    # ranked after the best settings
+    df.index += 2
+    fullPrint(df)
+
+
 def printProfits(pairs, days=30):
     coins = [x[5:] for x in pairs]
-    df = pd.DataFrame(columns=["Base", "Profit", "First Closed"])
-    success = False
-    for coin in coins:
-        success, deals = get_deals(coin, days)
-        while not success:
-            print(coin, "deals failed. Retying in a sec...")
-            time.sleep(1)
-            success, deals = get_deals(coin, days)
-        if len(deals) == 0:
-            df.loc[len(df)] = [coin, 0, ""]
-            continue
-        firstClosed = deals.loc[len(deals) - 1]["closed_at"]
-        profit = deals["actual_profit"].sum()
-        df.loc[len(df)] = [coin, profit, firstClosed[: firstClosed.index("T")]]
+    for attempt in range(tcRetries + 1):
+        if syncDeals():
+            break
+        if attempt == tcRetries:
+            raise RuntimeError("Deals sync failed")
+        print("Deals sync failed. Retying...")
+        time.sleep(tcBackoff * 2 ** attempt)
+    since = (archive.now() - timedelta(days=days)).isoformat()
+    db = getDealsDB()
+    profits = pd.read_sql_query(
+        """SELECT base AS Base, SUM(actual_profit) AS Profit,
+            substr(MIN(closed_at), 1, 10) AS "First Closed"
+        FROM deals WHERE closed_at >= ? GROUP BY base""",
+        db,
+        params=(since,),
+    )
+    db.close()
+    df = pd.DataFrame({"Base": coins}).merge(profits, on="Base", how="left")
+    df = df.fillna({"Profit": 0, "First Closed": ""})
     df = df.sort_values(by=["Profit"])
     df.reset_index(inplace=True, drop=True)
     print(df)
     print(df["Profit"].sum())
 
 
-def getBestBotSettings(usdt, givenBounce=0, minSafetys=7):
+# optimizer grid, see getBestBotSettings
+baseOrders = range(10, 20)
+safetyOrderStep = 0.1
+safetyVolumeScales = np.arange(1.01, 2, 0.01)
+safetySteps = np.arange(1.1, 3, 0.01)
+safetyStepScales = np.arange(1, 1.501, 0.01)
+maxSafetys = 100
+optimizerTakeProfit = 1.5
+ladderTablesPath = "./optimizer-data"
+ladderTables = None
+frontiers = {}
+dealsPath = "./3commas-data/deals.sqlite"
+
+
+def buildLadderTables(folder):
+    # running sums of safetyStepScale ** i, the price drop ladder per 1% safety step
+    drops = np.cumsum(safetyStepScales[:, None] ** np.arange(maxSafetys), axis=1)
+    volumeScales = safetyVolumeScales[:, None]
+    tables = {
+        "drops": drops,
+        # sum of safetyVolumeScale ** i for i < mstc, the volume ladder per 1$ order
+        "volumeSums": (1 - volumeScales ** np.arange(1, maxSafetys + 1))
+        / (1 - volumeScales),
+        # sum of drops[k] * safetyVolumeScale ** k for k < mstc
+        "weightedDrops": np.cumsum(
+            drops[:, None, :] * volumeScales ** np.arange(maxSafetys), axis=2
+        ),
+    }
+    os.makedirs(folder, exist_ok=True)
+    for name, table in tables.items():
+        path = os.path.join(folder, f"{name}.npy")
+        tmpPath = os.path.join(folder, f"{name}.{os.getpid()}.npy")
+        np.save(tmpPath, table)
+        os.replace(tmpPath, path)
+
+
+def getLadderTables():
+    """Martingale ladders of the optimizer grid, memory-mapped from disk
+
+    Indexed by [safetyStepScale, mstc - 1], [safetyVolumeScale, mstc - 1] and
+    [safetyStepScale, safetyVolumeScale, mstc - 1]. Built on first use for
+    every grid and stored under ladderTablesPath.
+    """
+    global ladderTables
+    if ladderTables is None:
+        grid = np.concatenate((safetyVolumeScales, safetyStepScales, [maxSafetys]))
+        folder = os.path.join(
+            ladderTablesPath, hashlib.sha1(grid.tobytes()).hexdigest()[:12]
+        )
+        names = ["drops", "volumeSums", "weightedDrops"]
+        paths = {name: os.path.join(folder, f"{name}.npy") for name in names}
+        if not all(map(os.path.exists, paths.values())):
+            buildLadderTables(folder)
+        ladderTables = {
+            name: np.load(path, mmap_mode="r") for name, path in paths.items()
+        }
+    return ladderTables
+
+
+def getBotSettingsForOrders(bo, so, usdt, givenBounce, minSafetys, top=1, floor=None):
+    """Up to top best priority tuples of one (bo, so) slice of the optimizer grid
+
+    Scores whole (safetyStep, safetyStepScale, mstc) blocks at once, one
+    safetyVolumeScale row at a time from the highest, so every setting of a
+    row beats those of the rows below it. Rows that can't beat floor are not
+    scored. Returned best first.
+    """
+    settings = []
+    mstcs = np.arange(minSafetys, maxSafetys + 1)
+    if len(mstcs) == 0:
+        return settings
+    tables = getLadderTables()
+    neededUSDT = tables["volumeSums"][:, minSafetys - 1 :] * so + bo
+    affordable = np.logical_and.accumulate(neededUSDT <= usdt, axis=1).sum(axis=1)
+    for row in np.flatnonzero(affordable)[::-1]:
+        safetyVolumeScale = safetyVolumeScales[row]
+        if len(settings) == top:
+            break
+        if floor is not None and (safetyVolumeScale, so) < floor[:2]:
+            break
+        count = affordable[row]
+        # other step scales are only tried when every mstc below maxSafetys fits
+        scales = len(safetyStepScales) if count >= len(mstcs) - 1 else 1
+        ladder = slice(minSafetys - 1, minSafetys - 1 + count)
+        volumeSums = 10 + so * tables["volumeSums"][row, ladder]
+        weightedDrops = so * tables["weightedDrops"][:scales, row, ladder]
+        drops = tables["drops"][:scales, ladder]
+        steps = safetySteps[:, None, None]
+        avgPrice = 100 - steps * (weightedDrops / volumeSums)
+        bounce = avgPrice * (1 + optimizerTakeProfit / 100) - 100
+        feasible = (bounce <= -givenBounce) & (steps * drops <= 100)
+        if not feasible.any():
+            continue
+        step, scale, mstc = np.nonzero(feasible)
+        order = np.lexsort(
+            (
+                -safetySteps[step],
+                safetyStepScales[scale],
+                mstc,
+                neededUSDT[row, mstc],
+                -bounce[step, scale, mstc],
+            )
+        )
+        for best in order[::-1][: top - len(settings)]:
+            # report with the scalar formulas so the numbers match them exactly
+            safetys = int(mstcs[mstc[best]])
+            safetyStep = safetySteps[step[best]]
+            safetyStepScale = safetyStepScales[scale[best]]
+            _, lowestTP = getBounceFromSettings(
+                so,
+                safetys,
+                safetyVolumeScale,
+                safetyStep,
+                optimizerTakeProfit,
+                safetyStepScale,
+            )
+            settings.append(
+                (
+                    safetyVolumeScale,
+                    so,
+                    -lowestTP,
+                    getNeededUSDTFromSettings(bo, so, safetys, safetyVolumeScale),
+                    bo,
+                    safetys,
+                    safetyStepScale,
+                    -safetyStep,
+                )
+            )
+    return settings
+
+
+def keepBestSettings(settings, setting, top):
+    """Pushes setting on the settings min-heap keeping only the top best"""
+    if len(settings) < top:
+        heapq.heappush(settings, setting)
+    elif setting > settings[0]:
+        heapq.heapreplace(settings, setting)
+
+
+def getSettingsFloor(settings, top, floor=None):
+    """Priority tuple a setting has to beat to get into settings"""
+    if len(settings) == top and (floor is None or settings[0] > floor):
+        return settings[0]
+    return floor
+
+
+def getBestBotSettingsInShard(shard, floor=None):
+    """Up to top best priority tuples of one shard of the optimizer grid"""
+    bo, safetyOrders, usdt, givenBounce, minSafetys, top = shard
+    settings = []
+    for so in safetyOrders:
+        for setting in getBotSettingsForOrders(
+            bo,
+            so,
+            usdt,
+            givenBounce,
+            minSafetys,
+            top,
+            getSettingsFloor(settings, top, floor),
+        ):
+            keepBestSettings(settings, setting, top)
+    return settings
+
+
+def getTopBotSettings(usdt, givenBounce=0, minSafetys=7, workers=1, top=1):
     # base order, safety order, max safetys, safety volume scale, used usdt, safety step, safety step scale, lowest tp %
     if minSafetys is None:
         minSafetys = 7
+    # priorities
+    # safety volume scale, safety order, -bounce, used usdt, base order, max safetys, safety step scale, -safety step
+    shards = [
+        (bo, safetyOrders, usdt, givenBounce, minSafetys, top)
+        for bo in baseOrders
+        for safetyOrders in np.array_split(
+            np.arange(bo, bo * 3, safetyOrderStep), max(workers, 1)
+        )
+        if len(safetyOrders)
+    ]
+    # loaded before the pool forks so the workers share the mapping
+    getLadderTables()
+    # every priority tuple is unique so the best ones don't depend on shard order
     settings = []
-    for bo in range(10, 20):
-        for so in np.arange(bo, bo * 3, 0.1):
-            for safetyVolumeScale in np.arange(1.01, 2, 0.01):
-                for safetyStep in np.arange(1.1, 3, 0.01):
-                    for safetyStepScale in np.arange(1, 1.501, 0.01):
-                        for mstc in range(minSafetys, 101):
-                            neededUSDT = getNeededUSDTFromSettings(
-                                bo,
-                                so,
-                                mstc,
-                                safetyVolumeScale,
-                            )
-                            if neededUSDT > usdt:
-                                break
-                            _, bounce = getBounceFromSettings(
-                                so,
-                                mstc,
-                                safetyVolumeScale,
-                                safetyStep,
-                                1.5,
-                                safetyStepScale,
-                            )
-
-                            # must haves
-                            if bounce > -givenBounce:
-                                continue
-                            # priorities
-                            settings.append(
-                                (
-                                    safetyVolumeScale,
-                                    so,
-                                    -bounce,
-                                    neededUSDT,
-                                    bo,
-                                    mstc,
-                                    safetyStepScale - safetyStep,
-                                )
-                            )
-                        if mstc < 100:
-                            break
+    with ExitStack() as stack:
+        if workers > 1:
+            pool = stack.enter_context(Pool(workers))
+            results = pool.imap_unordered(getBestBotSettingsInShard, shards)
+        else:
+            # lazy so every shard is pruned by the settings found so far
+            results = (
+                getBestBotSettingsInShard(shard, getSettingsFloor(settings, top))
+                for shard in shards
+            )
+        for shardSettings in tqdm(
+            results, total=len(shards), desc="Optimizing", disable=None
+        ):
+            for setting in shardSettings:
+                keepBestSettings(settings, setting, top)
 
     # base order, safety order, max safetys, safety volume scale, used usdt, safety step, safety step scale, lowest tp %
-    settings.sort()
-    settings = [(x[4], x[1], x[5], x[0], x[3], -x[7], x[6], -x[2]) for x in settings]
-    # [print(setting) for setting in settings[-100:]]
+    settings.sort(reverse=True)
+    return [(x[4], x[1], x[5], x[0], x[3], -x[7], x[6], -x[2]) for x in settings]
+
+
+def getBestBotSettings(usdt, givenBounce=0, minSafetys=7, workers=1):
+    settings = getTopBotSettings(usdt, givenBounce, minSafetys, workers)
     if len(settings):
-        return settings[-1]
+        return settings[0]
     return 0, 0, 0, 0, 0, 0, 0, 0
 
 
-def get_deals(coin, days=30):
-    now = datetime.now()
-    month_ago = now - timedelta(days=days)
-    resp = p3cw.request(
-        entity="deals",
-        action="",
-        payload={
-            "limit": 1000,
-            "scope": "completed",
-            "from": month_ago.isoformat(),
-            "base": coin,
-        },
+def getFrontierRow(shard):
+    """Settings of one safetyVolumeScale row that can be the best for some budget
+    and bounce target, as frontier columns
+
+    Only the largest feasible safetyStep of a (step scale, mstc) can be best, it
+    lowers the bounce at no cost. Per (bo, so) and step scale class, which sets
+    the budget a setting needs (see getBotSettingsForOrders), only settings with
+    a lower bounce than every cheaper one are kept.
+    """
+    row, minSafetys = shard
+    tables = getLadderTables()
+    ladder = slice(minSafetys - 1, maxSafetys)
+    mstcs = np.arange(minSafetys, maxSafetys + 1)
+    fits = safetySteps[:, None, None] * tables["drops"][:, ladder] <= 100
+    step = fits.sum(axis=0) - 1
+    steps = safetySteps[np.maximum(step, 0)]
+    volumeSums = tables["volumeSums"][row, ladder]
+    columns = []
+    for bo in baseOrders:
+        sos = np.arange(bo, bo * 3, safetyOrderStep)[:, None]
+        # the operations of getBotSettingsForOrders, so the bounces match exactly
+        weightedDrops = sos[:, None] * tables["weightedDrops"][:, row, ladder]
+        avgPrice = 100 - steps * (weightedDrops / (10 + sos[:, None] * volumeSums))
+        bounce = avgPrice * (1 + optimizerTakeProfit / 100) - 100
+        bounce[:, step < 0] = np.inf
+        neededUSDT = volumeSums * sos + bo
+        # the first step scale, and the best of all that need every mstc below
+        # maxSafetys affordable
+        scale = len(safetyStepScales) - 1 - np.argmin(bounce[:, ::-1], axis=1)
+        scales = np.concatenate([np.zeros_like(scale), scale], axis=1)
+        safetys = np.concatenate([mstcs, mstcs])
+        bounces = np.concatenate(
+            [bounce[:, 0], np.take_along_axis(bounce, scale[:, None], axis=1)[:, 0]],
+            axis=1,
+        )
+        needed = np.concatenate(
+            [
+                neededUSDT,
+                np.maximum(neededUSDT, neededUSDT[:, [max(len(mstcs) - 2, 0)]]),
+            ],
+            axis=1,
+        )
+        order = np.argsort(needed, axis=1, kind="stable")
+        bounces = np.take_along_axis(bounces, order, axis=1)
+        cheaper = np.minimum.accumulate(bounces, axis=1)
+        keep = np.isfinite(bounces)
+        keep[:, 1:] &= bounces[:, 1:] <= cheaper[:, :-1]
+        so, kept = np.nonzero(keep)
+        kept = order[so, kept]
+        columns.append(
+            {
+                "needed": needed[so, kept],
+                "bounce": bounces[keep],
+                "used": np.concatenate([neededUSDT, neededUSDT], axis=1)[so, kept],
+                "bo": np.full(len(so), bo),
+                "so": sos[so, 0],
+                "mstc": safetys[kept],
+                "scale": scales[so, kept],
+                "step": step[scales[so, kept], safetys[kept] - minSafetys],
+            }
+        )
+    return {name: np.concatenate([c[name] for c in columns]) for name in columns[0]}
+
+
+def buildFrontier(folder, minSafetys, workers=1):
+    """Frontier of the optimizer grid for minSafetys, sorted by needed budget
+
+    Rows go from the highest safetyVolumeScale down and drop the settings a
+    higher one beats on both budget and bounce, so what is left is close to
+    the Pareto frontier of (needed USDT, bounce, priority).
+    """
+    shards = [(row, minSafetys) for row in range(len(safetyVolumeScales))[::-1]]
+    getLadderTables()
+    parts = []
+    # lowest bounce of any budget over the rows so far, as a staircase
+    stairNeeded = np.array([-np.inf])
+    stairBounce = np.array([np.inf])
+    with ExitStack() as stack:
+        if workers > 1:
+            pool = stack.enter_context(Pool(workers))
+            rows = pool.imap(getFrontierRow, shards)
+        else:
+            rows = map(getFrontierRow, shards)
+        for (row, _), part in tqdm(
+            zip(shards, rows), total=len(shards), desc="Indexing", disable=None
+        ):
+            stair = np.searchsorted(stairNeeded, part["needed"], side="right") - 1
+            beaten = stairBounce[stair] <= part["bounce"]
+            part = {name: column[~beaten] for name, column in part.items()}
+            part["row"] = np.full(len(part["needed"]), row)
+            parts.append(part)
+            needed = np.concatenate([stairNeeded, part["needed"]])
+            bounce = np.concatenate([stairBounce, part["bounce"]])
+            order = np.lexsort((bounce, needed))
+            needed, bounce = needed[order], np.minimum.accumulate(bounce[order])
+            lower = np.concatenate([[True], bounce[1:] < bounce[:-1]])
+            stairNeeded, stairBounce = needed[lower], bounce[lower]
+    frontier = {name: np.concatenate([p[name] for p in parts]) for name in parts[0]}
+    # priorities as in getTopBotSettings
+    priority = np.lexsort(
+        (
+            -frontier["step"],
+            frontier["scale"],
+            frontier["mstc"],
+            frontier["bo"],
+            frontier["used"],
+            -frontier["bounce"],
+            frontier["so"],
+            frontier["row"],
+        )
     )
-    if "error" in resp and resp["error"]:
-        return (False, False)
-    deals = pd.DataFrame(resp[1])
-    while len(resp[1]) != 0:
-        resp = p3cw.request(
+    frontier["rank"] = np.empty(len(priority), dtype=np.int64)
+    frontier["rank"][priority] = np.arange(len(priority))
+    order = np.argsort(frontier["needed"], kind="stable")
+    os.makedirs(folder, exist_ok=True)
+    for name, column in frontier.items():
+        tmpPath = os.path.join(folder, f"{name}.{os.getpid()}.npy")
+        np.save(tmpPath, column[order])
+        os.replace(tmpPath, os.path.join(folder, f"{name}.npy"))
+
+
+def getFrontierPath(minSafetys):
+    grid = np.concatenate(
+        (
+            baseOrders,
+            [safetyOrderStep, maxSafetys, optimizerTakeProfit],
+            safetyVolumeScales,
+            safetySteps,
+            safetyStepScales,
+        )
+    )
+    return os.path.join(
+        ladderTablesPath,
+        "frontier-" + hashlib.sha1(grid.tobytes()).hexdigest()[:12],
+        str(minSafetys),
+    )
+
+
+def getFrontier(minSafetys):
+    """Frontier built by --build-index for minSafetys, memory-mapped, None if
+    it wasn't built for the current grid"""
+    if minSafetys not in frontiers:
+        folder = getFrontierPath(minSafetys)
+        if not os.path.exists(os.path.join(folder, "rank.npy")):
+            return None
+        frontiers[minSafetys] = {
+            name[: -len(".npy")]: np.load(os.path.join(folder, name), mmap_mode="r")
+            for name in os.listdir(folder)
+            if name.endswith(".npy")
+        }
+    return frontiers[minSafetys]
+
+
+def getIndexedBotSettings(usdt, givenBounce=0, minSafetys=7):
+    """getTopBotSettings(usdt, givenBounce, minSafetys) answered from the frontier
+    of --build-index, None if it wasn't built"""
+    if minSafetys is None:
+        minSafetys = 7
+    frontier = getFrontier(minSafetys)
+    if frontier is None:
+        return None
+    affordable = np.searchsorted(frontier["needed"], usdt, side="right")
+    feasible = np.flatnonzero(frontier["bounce"][:affordable] <= -givenBounce)
+    if len(feasible) == 0:
+        return []
+    best = feasible[np.argmax(frontier["rank"][feasible])]
+    bo = int(frontier["bo"][best])
+    so = frontier["so"][best]
+    mstc = int(frontier["mstc"][best])
+    safetyVolumeScale = safetyVolumeScales[frontier["row"][best]]
+    safetyStep = safetySteps[frontier["step"][best]]
+    safetyStepScale = safetyStepScales[frontier["scale"][best]]
+    _, lowestTP = getBounceFromSettings(
+        so, mstc, safetyVolumeScale, safetyStep, optimizerTakeProfit, safetyStepScale
+    )
+    return [
+        (
+            bo,
+            so,
+            mstc,
+            safetyVolumeScale,
+            getNeededUSDTFromSettings(bo, so, mstc, safetyVolumeScale),
+            safetyStep,
+            safetyStepScale,
+            lowestTP,
+        )
+    ]
+
+
+def getDealsDB():
+    """Completed deals of every bot, keyed by deal id"""
+    os.makedirs(os.path.dirname(dealsPath), exist_ok=True)
+    db = sqlite3.connect(dealsPath, timeout=60)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS deals (
+            id INTEGER PRIMARY KEY,
+            bot_id INTEGER,
+            pair TEXT,
+            base TEXT,
+            closed_at TEXT,
+            actual_profit REAL,
+            actual_usd_profit REAL,
+            final_profit REAL,
+            usd_final_profit REAL
+        )"""
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS deals_closed_at ON deals (closed_at)")
+    return db
+
+
+def syncDeals():
+    """Store the deals closed since the last sync, newest first until reaching
+    stored ones. The first sync downloads every completed deal."""
+    db = getDealsDB()
+    (mark,) = db.execute("SELECT MAX(closed_at) FROM deals").fetchone()
+
+    def getPage(offset):
+        return request(
             entity="deals",
             action="",
             payload={
                 "limit": 1000,
                 "scope": "completed",
-                "offset": len(deals),
-                "from": month_ago.isoformat(),
-                "base": coin,
+                "order": "closed_at",
+                "order_direction": "desc",
+                "offset": offset,
             },
         )
-        deals = deals.append(resp[1])
-    deals.reset_index(inplace=True, drop=True)
-    if len(deals) > 0:
-        deals[
-            ["actual_usd_profit", "final_profit", "usd_final_profit", "actual_profit"]
-        ] = deals[
-            ["actual_usd_profit", "final_profit", "usd_final_profit", "actual_profit"]
-        ].apply(
-            pd.to_numeric
+
+    # a full page means there are more, without a mark fetch them a batch at a time
+    batch = tcWorkers if mark is None else 1
+    resps = [getPage(0)]
+    while (
+        len(resps[-1][0]) == 0
+        and len(resps[-1][1]) == 1000
+        and (mark is None or resps[-1][1][-1]["closed_at"] > mark)
+    ):
+        offset = 1000 * len(resps)
+        resps += fanOut(getPage, range(offset, offset + 1000 * batch, 1000))
+    if any(len(resp[0]) for resp in resps):
+        db.close()
+        return False
+    with db:
+        db.executemany(
+            "INSERT OR REPLACE INTO deals VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    deal["id"],
+                    deal["bot_id"],
+                    deal["pair"],
+                    deal["pair"][deal["pair"].index("_") + 1 :],
+                    deal["closed_at"],
+                    float(deal["actual_profit"]),
+                    float(deal["actual_usd_profit"]),
+                    float(deal["final_profit"]),
+                    float(deal["usd_final_profit"]),
+                )
+                for resp in resps
+                for deal in resp[1]
+            ],
         )
+    db.close()
+    return True
+
+
+def get_deals(coin, days=30):
+    if not syncDeals():
+        return (False, False)
+    since = (archive.now() - timedelta(days=days)).isoformat()
+    db = getDealsDB()
+    deals = pd.read_sql_query(
+        """SELECT * FROM deals WHERE base = ? AND closed_at >= ?
+        ORDER BY closed_at DESC""",
+        db,
+        params=(coin, since),
+    )
+    db.close()
     return (True, deals)
 
 
-def get_bot(name="TA_COMPOSITE"):
-    resp = p3cw.request(
+def get_bots():
+    """Every enabled bot"""
+    resp = request(
         entity="bots",
         action="",
         payload={"scope": "enabled"},
     )
     bots = pd.DataFrame(resp[1])
-    bots = bots[bots["name"] == name]
-    bots.reset_index(inplace=True, drop=True)
     bots[
         [
             "id",
@@ -290,9 +794,80 @@ def get_bot(name="TA_COMPOSITE"):
     ].apply(
         pd.to_numeric
     )
+    return bots
+
+
+def get_bot(name="TA_COMPOSITE"):
+    bots = get_bots()
+    bots = bots[bots["name"] == name]
+    bots.reset_index(inplace=True, drop=True)
     return bots.loc[0]
 
 
+def getBounceTarget(bot, extraBounce=0):
+    """Bounce the bot's current settings reach, plus extraBounce"""
+    return (
+        int(
+            -getBounceFromSettings(
+                bot["safety_order_volume"],
+                bot["max_safety_orders"],
+                bot["martingale_volume_coefficient"],
+                bot[str(Properties.SOS)],
+                bot[str(Properties.TP)],
+                bot[str(Properties.SS)],
+            )[1]
+        )
+        + extraBounce
+    )
+
+
+def hasSettings(bot, bo, so, os, mstc, sos, ss):
+    return (
+        cmpFloat(bo, bot[str(Properties.BO)])
+        and cmpFloat(so, bot[str(Properties.SO)])
+        and cmpFloat(os, bot[str(Properties.OS)])
+        and mstc == bot[str(Properties.MSTC)]
+        and cmpFloat(sos, bot[str(Properties.SOS)])
+        and cmpFloat(ss, bot[str(Properties.SS)])
+    )
+
+
+def updateBot(bot, numBots, bo, so, os, ss, mstc, sos):
+    # bots from get_bots hold numpy numbers, which py3cw can't json.dumps
+    return request(
+        entity="bots",
+        action="update",
+        action_id=str(bot["id"]),
+        payload={
+            "name": bot["name"],
+            "pairs": list(bot["pairs"]),
+            "max_active_deals": int(numBots),
+            str(Properties.BO): float(bo),
+            str(Properties.TP): float(bot[str(Properties.TP)]),
+            str(Properties.SO): float(so),
+            str(Properties.OS): float(os),
+            str(Properties.SS): float(ss),
+            str(Properties.MSTC): int(mstc),
+            "active_safety_orders_count": int(bot["active_safety_orders_count"]),
+            str(Properties.SOS): float(sos),
+            "take_profit_type": bot["take_profit_type"],
+            "strategy_list": bot["strategy_list"],
+            "bot_id": int(bot["id"]),
+        },
+    )
+
+
+def getFleetBotSettings(shard):
+    """Best settings of one fleet bot, from the frontier index when built"""
+    usdt, givenBounce, minSafetys = shard
+    settings = getIndexedBotSettings(usdt, givenBounce, minSafetys)
+    if settings is None:
+        settings = getTopBotSettings(usdt, givenBounce, minSafetys)
+    if len(settings):
+        return settings[0]
+    return None
+
+
 def fullPrint(df, rows=None, cols=None):
     with pd.option_context("display.max_rows", rows, "display.max_columns", cols):
         print(df)
@@ -329,6 +904,14 @@ class Main:
         self.bounce = 0
         self.extraSafetys = None
         self.onlySafetyOrder = False
+        self.workers = 1
+        self.top = 1
+        self.daemon = None
+        self.buildIndex = None
+        self.fleet = False
+        self.threshold = 1
+        self.client = None
+        self.lowBNB = False
 
         for arg in sys.argv[1:]:
             if not arg.startswith("--"):
@@ -366,6 +949,20 @@ class Main:
                 self.bounce = float(val)
             elif key in ["extra-safetys", "extra-safeteys"]:
                 self.extraSafetys = int(val)
+            elif key == "workers":
+                self.workers = int(val)
+            elif key == "top":
+                self.top = int(val)
+                if self.top < 1:
+                    raise KeyError(f"Option --top needs at least 1")
+            elif key == "daemon":
+                self.daemon = 60 if val == 1 else int(val)
+            elif key == "threshold":
+                self.threshold = float(val)
+            elif key == "fleet":
+                self.fleet = int(val) == 1
+            elif key == "build-index":
+                self.buildIndex = 7 if val == 1 else int(val)
             elif key.startswith("o-") or key.startswith("only-"):
                 key = key[key.index("-") + 1 :]
                 if key == "so":
@@ -381,51 +978,210 @@ class Main:
                 raise KeyError(f"Options --profits and --needed conflict")
             if self.safetys and self.profits:
                 raise KeyError(f"Options --profits and --safetys conflict")
-        self.bot = get_bot()
+        if self.buildIndex is not None:
+            buildFrontier(
+                getFrontierPath(self.buildIndex), self.buildIndex, self.workers
+            )
+            return
+        self.givenUSDT = self.usdt
+        self.givenBounce = self.bounce
+        if self.fleet:
+            self.runFleet()
+            return
+        self.setBot(get_bot())
+        if self.daemon:
+            self.runDaemon()
+        else:
+            self.main()
+
+    def setBot(self, bot):
+        self.bot = bot
         self.numBots = self.bot["max_active_deals"] + self.extraBots
-        if not self.bounce and self.extraSafetys is None:
-            self.bounce = (
-                int(
-                    -getBounceFromSettings(
-                        self.bot["safety_order_volume"],
-                        self.bot["max_safety_orders"],
-                        self.bot["martingale_volume_coefficient"],
-                        self.bot[str(Properties.SOS)],
-                        self.bot[str(Properties.TP)],
-                        self.bot[str(Properties.SS)],
-                    )[1]
+        if not self.givenBounce and self.extraSafetys is None:
+            self.bounce = getBounceTarget(self.bot, self.extraBounce)
+
+    def runDaemon(self):
+        """Rebalance every self.daemon seconds, re-optimizing only when the per
+        bot budget moved by self.threshold USDT or the bounce target changed
+
+        The bot is kept in memory with the settings last sent to it, a changed
+        fetch means it was edited elsewhere and its bounce target is recomputed.
+        """
+        optimized = None
+        while True:
+            try:
+                bot = get_bot()
+                if bot["max_active_deals"] != self.bot["max_active_deals"] or any(
+                    not cmpFloat(bot[str(property)], self.bot[str(property)])
+                    for property in Properties
+                ):
+                    self.setBot(bot)
+                self.usdt = self.givenUSDT
+                self.setTotalUSDT()
+                usdtPerBot = (self.usdt + self.extraUSDT) / self.numBots
+                if (
+                    optimized is None
+                    or abs(usdtPerBot - optimized[0]) >= self.threshold
+                    or self.bounce != optimized[1]
+                ):
+                    # a failed update is retried on the next cycle
+                    if self.rebalance():
+                        optimized = (usdtPerBot, self.bounce)
+            except Exception as e:
+                print(datetime.now(), "Rebalancing failed:", e)
+            metrics.write()
+            time.sleep(self.daemon)
+
+    def runFleet(self):
+        """Optimize every enabled bot at once and apply one update plan
+
+        Every bot gets a share of the USDT for each of its max_active_deals,
+        weighted by what its current settings need per deal, so bots set up
+        for deeper bounces keep proportionally more. Bots are optimized in
+        parallel with --workers, each against its own bounce target.
+        """
+        bots = get_bots()
+        self.setTotalUSDT()
+        needed = np.array(
+            [
+                getNeededUSDTFromSettings(
+                    bot[str(Properties.BO)],
+                    bot[str(Properties.SO)],
+                    bot[str(Properties.MSTC)],
+                    bot[str(Properties.OS)],
                 )
-                + self.extraBounce
+                for _, bot in bots.iterrows()
+            ]
+        )
+        usdtPerDeal = (
+            (self.usdt + self.extraUSDT)
+            * needed
+            / (bots["max_active_deals"].to_numpy() * needed).sum()
+        )
+        shards = [
+            (
+                usdt,
+                (
+                    self.givenBounce
+                    if self.givenBounce or self.extraSafetys is not None
+                    else getBounceTarget(bot, self.extraBounce)
+                ),
+                (
+                    None
+                    if self.extraSafetys is None
+                    else bot[str(Properties.MSTC)] + self.extraSafetys
+                ),
+            )
+            for usdt, (_, bot) in zip(usdtPerDeal, bots.iterrows())
+        ]
+        # loaded before the pool forks so the workers share the mapping
+        getLadderTables()
+        with ExitStack() as stack:
+            if self.workers > 1:
+                pool = stack.enter_context(Pool(self.workers))
+                results = pool.imap(getFleetBotSettings, shards)
+            else:
+                results = map(getFleetBotSettings, shards)
+            plan = list(
+                tqdm(results, total=len(shards), desc="Optimizing", disable=None)
             )
-        self.main()
+
+        rows = []
+        updates = []
+        for (_, bot), (usdt, bounce, _), settings in zip(bots.iterrows(), shards, plan):
+            if settings is None:
+                rows.append(
+                    [bot["name"], bot["max_active_deals"], usdt, bounce]
+                    + [math.nan] * 8
+                    + ["Unfeasable"]
+                )
+                continue
+            bo, so, mstc, os, neededUSDT, sos, ss, lowestTPPercent = settings
+            same = hasSettings(bot, bo, so, os, mstc, sos, ss)
+            rows.append(
+                [bot["name"], bot["max_active_deals"], usdt, bounce]
+                + [bo, so, mstc, os, neededUSDT, sos, ss, lowestTPPercent]
+                + ["" if same else "Update"]
+            )
+            if not same:
+                updates.append(
+                    (bot, bot["max_active_deals"], bo, so, os, ss, mstc, sos)
+                )
+        df = pd.DataFrame(
+            rows,
+            columns=[
+                "Bot",
+                "Pairs",
+                "$ / deal",
+                "Bounce",
+                "Base Order",
+                "Safety Order",
+                "Max Safetys",
+                "Volume Scale",
+                "$ / bot",
+                "Step",
+                "Step Scale",
+                "Lowest TP %",
+                "Plan",
+            ],
+        )
+        content = f"Fleet of {len(bots)} bots with {self.usdt:.0f} USDT"
+        if self.auto:
+            postDiscord(f"""{content}\n```{df.to_string()}```""")
+        else:
+            print(content)
+            fullPrint(df)
+        if not self.live or len(updates) == 0:
+            return
+
+        resps = fanOut(lambda update: updateBot(*update), updates)
+        failed = [
+            f"{update[0]['name']}: {resp[0]}"
+            for update, resp in zip(updates, resps)
+            if len(resp[0].keys())
+        ]
+        result = f"{len(updates) - len(failed)} / {len(updates)} bots updated"
+        result = "\n".join([result, *failed])
+        if self.auto:
+            postDiscord(result)
+        else:
+            print(result)
 
     def setTotalUSDT(self):
         if self.usdt is None:
-            client = Client(
-                config.binance_key,
-                config.binance_secret,
-                {"verify": False, "timeout": 20},
-            )
-            balances = getBalances(client)
-            bnb = balances[balances["asset"] == "BNB"]["total"].values[0]
-            bnb = bnb * getPrice(client, "BNB")
-            if bnb < 10:
-                res = requests.post(
-                    config.discordHook,
-                    {"content": f"""{bnb} BNB left!!!!"""},
+            if self.client is None:
+                self.client = archive.getBinanceClient(getConfig)
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                balances = executor.submit(getBalances, self.client)
+                bnbPrice = executor.submit(getPrice, self.client, "BNB")
+                active = executor.submit(
+                    request,
+                    entity="deals",
+                    action="",
+                    payload=(
+                        {"scope": "active", "limit": 1000}
+                        if self.fleet
+                        else {"bot_id": self.bot["id"], "scope": "active"}
+                    ),
+                )
+                balances, bnbPrice, resp = (
+                    balances.result(),
+                    bnbPrice.result(),
+                    active.result(),
                 )
+            bnb = balances[balances["asset"] == "BNB"]["total"].values[0]
+            bnb = bnb * bnbPrice
+            # warn once per drop below 10, the daemon gets here every cycle
+            if bnb < 10 and not self.lowBNB:
+                postDiscord(f"""{bnb} BNB left!!!!""")
+            self.lowBNB = bnb < 10
 
             self.usdt = balances[balances["asset"] == "USDT"]["total"].values[0]
-            resp = p3cw.request(
-                entity="deals",
-                action="",
-                payload={"bot_id": self.bot["id"], "scope": "active"},
-            )
-            deals = pd.DataFrame(resp[1])
-            deals = deals[["pair", "bought_volume", str(Properties.TP)]]
-
-            for i in range(len(deals)):
-                deal = deals.loc[i]
+            # a failed request would drop the capital in open deals from the budget
+            if len(resp[0]):
+                raise RuntimeError(f"Active deals request failed: {resp[0]}")
+            # no active deals is a normal state for the daemon
+            for deal in resp[1]:
                 self.usdt += float(deal["bought_volume"]) * (
                     1 + float(deal["take_profit"]) / 100
                 )
@@ -474,6 +1230,10 @@ class Main:
             return
 
         self.setTotalUSDT()
+        self.rebalance()
+
+    def rebalance(self):
+        """Optimize the bot and update it when live, False if the update failed"""
         minSafetys = (
             None
             if self.extraSafetys is None
@@ -502,23 +1262,41 @@ class Main:
                 self.bot[str(Properties.SS)],
             )[1],
         )
+        runnersUp = []
         if self.onlySafetyOrder:
             so = self.getBotSettingsChangeOnlyOneProperty(Properties.SO)
             if so == self.bot[str(Properties.BO)]:
                 bo = 0
         else:
-            (
-                bo,
-                so,
-                mstc,
-                os,
-                neededUSDT,
-                sos,
-                ss,
-                lowestTPPercent,
-            ) = getBestBotSettings(
-                (self.usdt + self.extraUSDT) / self.numBots, self.bounce, minSafetys
-            )
+            settings = None
+            if self.top == 1:
+                settings = getIndexedBotSettings(
+                    (self.usdt + self.extraUSDT) / self.numBots,
+                    self.bounce,
+                    minSafetys,
+                )
+            if settings is None:
+                settings = getTopBotSettings(
+                    (self.usdt + self.extraUSDT) / self.numBots,
+                    self.bounce,
+                    minSafetys,
+                    self.workers,
+                    self.top,
+                )
+            if len(settings):
+                (
+                    bo,
+                    so,
+                    mstc,
+                    os,
+                    neededUSDT,
+                    sos,
+                    ss,
+                    lowestTPPercent,
+                ) = settings[0]
+                runnersUp = settings[1:]
+            else:
+                bo = 0
 
         if bo == 0:
             extra = ""
@@ -530,7 +1308,7 @@ with {self.usdt:.0f} USDT{extra}
 
 Unfeasable"""
             )
-            return
+            return True
 
         if self.safetys is None:
             printSafetys(
@@ -555,73 +1333,56 @@ Using $ / bot:             {neededUSDT:.2f}
 Using $:                   {neededUSDT*self.numBots:.2f} / {self.usdt:.2f}
 Lowest Take Profit %:      {lowestTPPercent:.2f}"""
         if self.auto:
-            res = requests.post(
-                config.discordHook,
-                {
-                    "content": f"""Bot `{self.bot['name']}` settings for `{self.numBots}` pairs\n```{content}```"""
-                },
+            postDiscord(
+                f"""Bot `{self.bot['name']}` settings for `{self.numBots}` pairs\n```{content}```"""
             )
         else:
             print(f"""Bot "{self.bot['name']}" settings for {self.numBots} pairs""")
             print(content)
+            if len(runnersUp):
+                print()
+                printRunnersUp(runnersUp)
 
-        allSame = (
-            cmpFloat(bo, self.bot[str(Properties.BO)])
-            and cmpFloat(so, self.bot[str(Properties.SO)])
-            and cmpFloat(os, self.bot[str(Properties.OS)])
-            and mstc == self.bot[str(Properties.MSTC)]
-            and cmpFloat(sos, self.bot[str(Properties.SOS)])
-            and cmpFloat(ss, self.bot[str(Properties.SS)])
-        )
+        allSame = hasSettings(self.bot, bo, so, os, mstc, sos, ss)
         if not self.live or allSame:
-            return
-        resp = p3cw.request(
-            entity="bots",
-            action="update",
-            action_id=str(self.bot["id"]),
-            payload={
-                "name": self.bot["name"],
-                "pairs": self.bot["pairs"],
-                "max_active_deals": self.numBots,
-                Properties.BO: bo,
-                Properties.TP: self.bot[str(Properties.TP)],
-                Properties.SO: so,
-                Properties.OS: os,
-                Properties.SS: ss,
-                Properties.MSTC: mstc,
-                "active_safety_orders_count": self.bot["active_safety_orders_count"],
-                Properties.SOS: sos,
-                "take_profit_type": self.bot["take_profit_type"],
-                "strategy_list": self.bot["strategy_list"],
-                "bot_id": self.bot["id"],
-            },
-        )
+            return True
+        resp = updateBot(self.bot, self.numBots, bo, so, os, ss, mstc, sos)
         if len(resp[0].keys()) == 0:
+            for property, value in [
+                (Properties.BO, bo),
+                (Properties.SO, so),
+                (Properties.OS, os),
+                (Properties.SS, ss),
+                (Properties.MSTC, mstc),
+                (Properties.SOS, sos),
+            ]:
+                self.bot[str(property)] = value
             if self.auto:
                 extraBotText = ""
                 if self.extraBots == 1:
                     extraBotText = "\nGo choose 1 more pair"
                 if self.extraBots > 1:
                     extraBotText = f"\nGo choose {self.extraBots} more pairs"
-                res = requests.post(
-                    config.discordHook,
-                    {
-                        "content": f"""Bot `{self.bot['name']}` settings updated{extraBotText}"""
-                    },
+                postDiscord(
+                    f"""Bot `{self.bot['name']}` settings updated{extraBotText}"""
                 )
             else:
-                res = requests.post(
-                    config.discordHook,
-                    {
-                        "content": f"""Bot `{self.bot['name']}` updated for `{self.numBots}` pairs\n```{content}```"""
-                    },
+                postDiscord(
+                    f"""Bot `{self.bot['name']}` updated for `{self.numBots}` pairs\n```{content}```"""
                 )
+            # the extra bots are part of max_active_deals now, the daemon would
+            # otherwise add them again on its next fetch
+            self.bot["max_active_deals"] = self.numBots
+            self.extraBots = 0
+            return True
+        if self.auto:
+            postDiscord(resp)
         else:
-            if self.auto:
-                res = requests.post(config.discordHook, {"content": resp})
-            else:
-                print(resp)
+            print(resp)
+        return False
 
 
 if __name__ == "__main__":
+    archive.configure()
+    metrics.configure()
     Main()
@@ -0,0 +1,191 @@
+import atexit
+import gzip
+import json
+import os
+import sys
+import threading
+from collections import defaultdict, deque
+from datetime import datetime
+
+import metrics
+
+defaultPath = "./replay-data/archive.json.gz"
+mode = None
+path = defaultPath
+calls = []
+byKey = defaultdict(deque)
+byArguments = defaultdict(deque)
+served = set()
+lock = threading.Lock()
+# arguments that follow the wall clock, a replay may pass other values
+clockArguments = ["startTime", "endTime"]
+# naive UTC wall clock of the recording, see now()
+startedAt = None
+
+
+def configure():
+    """Takes --record[=path] / --replay[=path] out of sys.argv, so the scripts'
+    own option parsing never sees them"""
+    global mode, path, startedAt
+    args = []
+    for arg in sys.argv[1:]:
+        key, _, val = arg[2:].partition("=")
+        if arg.startswith("--") and key in ["record", "replay"]:
+            mode = key
+            path = val or defaultPath
+        else:
+            args.append(arg)
+    sys.argv[1:] = args
+    if mode == "record":
+        startedAt = datetime.utcnow()
+        atexit.register(save)
+    elif mode == "replay":
+        load()
+
+
+def replaying():
+    return mode == "replay"
+
+
+def now():
+    """Naive UTC now, frozen at the start of a recording and served back from
+    it when replaying, so ranges clamped to the present ask for the same
+    candles both times"""
+    if startedAt is None:
+        return datetime.utcnow()
+    return startedAt
+
+
+def save():
+    """Writes the recorded calls atomically, one JSON row per call"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with lock:
+        rows = list(calls)
+    clock = ["archive", "now", getKey([], {}), {"value": now().isoformat()}]
+    with gzip.open(path + ".tmp", "wt") as f:
+        for row in [clock, *rows]:
+            f.write(json.dumps(row, separators=(",", ":")) + "\n")
+    os.replace(path + ".tmp", path)
+    print(f"Recorded {len(rows)} calls to {path}", file=sys.stderr)
+
+
+def load():
+    global startedAt
+    with gzip.open(path, "rt") as f:
+        for line in f:
+            row = json.loads(line)
+            if row[0] == "archive" and row[1] == "now":
+                startedAt = datetime.fromisoformat(row[3]["value"])
+            else:
+                calls.append(row)
+    for i, (name, method, key, _) in enumerate(calls):
+        byKey[(name, method, key)].append(i)
+        args, kwargs = json.loads(key)
+        byArguments[(name, method, getKey(args, kwargs, clockArguments))].append(i)
+
+
+def normalise(value):
+    """value with str dict keys, payloads mix Properties and str keys"""
+    if isinstance(value, dict):
+        return {str(key): normalise(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalise(item) for item in value]
+    return value
+
+
+def getKey(args, kwargs, ignored=()):
+    kwargs = {key: value for key, value in kwargs.items() if key not in ignored}
+    return json.dumps(normalise([args, kwargs]), sort_keys=True, default=str)
+
+
+def serve(name, method, args, kwargs):
+    """The recorded response for a call, matched on all its arguments first
+    and then on all but clockArguments, in the order they were recorded"""
+    key = getKey(args, kwargs)
+    with lock:
+        for queue in [
+            byKey[(name, method, key)],
+            byArguments[(name, method, getKey(args, kwargs, clockArguments))],
+        ]:
+            while len(queue) and queue[0] in served:
+                queue.popleft()
+            if len(queue):
+                i = queue.popleft()
+                served.add(i)
+                return calls[i][3]
+    raise KeyError(f"{name}.{method}({key}) is not in archive {path}")
+
+
+def getError(error):
+    """A recorded exception as a row, only the Binance API errors the scripts
+    handle are replayed as themselves"""
+    from binance.exceptions import BinanceAPIException
+
+    if isinstance(error, BinanceAPIException):
+        text = json.dumps({"code": error.code, "msg": error.message})
+        return {"binance": [error.status_code, text]}
+    return {"other": [type(error).__name__, str(error)]}
+
+
+def raiseError(error):
+    if "binance" in error:
+        from binance.exceptions import BinanceAPIException
+
+        raise BinanceAPIException(None, *error["binance"])
+    raise RuntimeError(*error["other"])
+
+
+class Recorder:
+    """Stands in for a client, every method call is recorded or replayed"""
+
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            if mode == "replay":
+                resp = serve(self.name, method, args, kwargs)
+                if "error" in resp:
+                    raiseError(resp["error"])
+                return resp["value"]
+            key = getKey(args, kwargs)
+            try:
+                value = getattr(self.client, method)(*args, **kwargs)
+            except Exception as e:
+                with lock:
+                    calls.append([self.name, method, key, {"error": getError(e)}])
+                raise
+            with lock:
+                calls.append([self.name, method, key, {"value": value}])
+            return value
+
+        return call
+
+
+def wrap(name, factory):
+    """The client factory() makes, recorded or replayed when a mode is set.
+    Replaying never calls factory(), constructing clients hits the network"""
+    if mode == "replay":
+        return Recorder(name, None)
+    if mode == "record":
+        return Recorder(name, factory())
+    return factory()
+
+
+def getBinanceClient(getConfig):
+    """Binance client of the scripts, recorded or replayed and instrumented.
+    Importing python-binance and constructing the client, which pings the
+    exchange, take a second, so the scripts call this on first use"""
+
+    def makeClient():
+        from binance.client import Client
+
+        client = Client(
+            getConfig().binance_key,
+            getConfig().binance_secret,
+            {"verify": False, "timeout": 20},
+        )
+        return metrics.instrument("binance", client)
+
+    return wrap("binance", makeClient)
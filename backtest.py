@@ -1,9 +1,17 @@
+import itertools
+import json
+import os
+import sys
 from datetime import datetime, timedelta
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import pandas as pd
-from binance.client import Client
+from tqdm import tqdm
 
+import archive
+import metrics
 from config import Config
 
 
@@ -23,13 +31,63 @@ safetyOrderVolumeDeviation = 1.05
 maxSafetyOrders = 15
 takeProfitPercentage = 1.015
 
-config = Config()
-client = Client(
-    config.binance_key, config.binance_secret, {"verify": False, "timeout": 20}
+granularityMilliseconds = {
+    "1m": 60000,
+    "5m": 300000,
+    "15m": 900000,
+    "1h": 3600000,
+    "6h": 21600000,
+    "1d": 86400000,
+}
+candleColumns = ["open_time", "open", "high", "low", "close", "volume"]
+candleDtypes = {
+    column: np.int64 if column == "open_time" else np.float64
+    for column in candleColumns
+}
+candleStorePath = "./backtest-data"
+
+# configurations compared by --sweep, every combination is simulated
+sweepGrid = {
+    "baseOrderVolume": [baseOrderVolume],
+    "firstSafetyOrderVolume": [firstSafetyOrderVolume],
+    "safetyOrderPriceDeviation": [0.97, 0.98, 0.99],
+    "safetyOrderVolumeDeviation": [1.05, 1.1, 1.2],
+    "maxSafetyOrders": [10, 15, 20],
+    "takeProfitPercentage": [1.01, 1.015, 1.02],
+}
+
+config = None
+client = None
+
+
+def getConfig():
+    global config
+    if config is None:
+        config = Config()
+    return config
+
+
+def getClient():
+    global client
+    if client is None:
+        client = archive.getBinanceClient(getConfig)
+    return client
+
+
+BASE_ORDER, SAFETY_ORDER, TAKE_PROFIT = range(3)
+fillDtype = np.dtype(
+    [
+        ("row", np.int64),
+        ("type", np.int8),
+        ("price", np.float64),
+        ("volume", np.float64),
+        ("coin", np.float64),
+        ("profit", np.float64),
+    ]
 )
 
 
-def main():
+def main(refine=False):
     tradingData = getTradingData()
     originalFunds = getNeededUSDTFromSettings(
         baseOrderVolume,
@@ -37,56 +95,384 @@ def main():
         maxSafetyOrders,
         safetyOrderVolumeDeviation,
     )
-    funds = originalFunds
-    coin = 0
-
-    currentBuyPrices = []
-    nextSafetyOrderPrice = 0
-    takeProfitOrderPrice = 0
-    fundsBeforeBaseOrder = funds
-    for _, row in tradingData.iterrows():
-        if len(currentBuyPrices) == 0:  # First row
-            coin = baseOrderVolume / row["open"]
-            funds -= baseOrderVolume
-            print(
-                f"{_}: Base order {coin} {baseCoin} for {baseOrderVolume} {quoteCoin}"
-            )
-            currentBuyPrices = [row["open"]]
-            avgBuyPrice = row["open"]
-            nextSafetyOrderPrice = row["open"] * safetyOrderPriceDeviation
-            nextSafetyOrderVolume = firstSafetyOrderVolume
-            takeProfitOrderPrice = avgBuyPrice * takeProfitPercentage
-        if row["low"] <= nextSafetyOrderPrice:
-            coin += nextSafetyOrderVolume / nextSafetyOrderPrice
-            funds -= nextSafetyOrderVolume
+    granularity = to_binance_granularity(int(getConfig().granularity))
+    intrabarCandles = None
+    if refine and granularity != "1m":
+        intrabarCandles, saveIntrabarCandles = getIntrabarCandles(
+            market, granularity, tradingData
+        )
+    fills, endFunds = simulateDeals(
+        tradingData["open"].to_numpy(),
+        tradingData["high"].to_numpy(),
+        tradingData["low"].to_numpy(),
+        originalFunds,
+        intrabarCandles,
+    )
+    if intrabarCandles is not None:
+        saveIntrabarCandles()
+    for fill in fills:
+        _ = tradingData.index[fill["row"]]
+        if fill["type"] == BASE_ORDER:
             print(
-                f"{_}: Safety order {nextSafetyOrderVolume / nextSafetyOrderPrice} {baseCoin} for {nextSafetyOrderVolume} {quoteCoin}"
-            )
-            currentBuyPrices.append(nextSafetyOrderPrice)
-            avgBuyPrice = sum(currentBuyPrices) / len(currentBuyPrices)
-            nextSafetyOrderPrice *= safetyOrderPriceDeviation
-            nextSafetyOrderVolume *= safetyOrderVolumeDeviation
-            takeProfitOrderPrice = avgBuyPrice * takeProfitPercentage
-        if row["high"] >= takeProfitOrderPrice:
-            funds += coin * takeProfitOrderPrice
-            print(f"{_}: Take profit {funds-fundsBeforeBaseOrder} {quoteCoin}")
-            fundsBeforeBaseOrder = funds
-            funds -= baseOrderVolume
-            coin = baseOrderVolume / takeProfitOrderPrice
+                f"{_}: Base order {fill['coin']} {baseCoin} for {baseOrderVolume} {quoteCoin}"
+            )
+        elif fill["type"] == SAFETY_ORDER:
             print(
-                f"{_}: Base order {coin} {baseCoin} for {baseOrderVolume} {quoteCoin}"
-            )
-            currentBuyPrices = [takeProfitOrderPrice]
-            avgBuyPrice = takeProfitOrderPrice
-            nextSafetyOrderPrice = takeProfitOrderPrice * safetyOrderPriceDeviation
-            nextSafetyOrderVolume = firstSafetyOrderVolume
-            takeProfitOrderPrice = avgBuyPrice * takeProfitPercentage
-    endFunds = fundsBeforeBaseOrder
+                f"{_}: Safety order {fill['coin']} {baseCoin} for {fill['volume']} {quoteCoin}"
+            )
+        else:
+            print(f"{_}: Take profit {fill['profit']} {quoteCoin}")
     print(
         f"{endFunds:.2f} - {originalFunds:.2f} = {endFunds-originalFunds:+.2f} {quoteCoin}"
     )
 
 
+def getListedPairs():
+    pairs = []
+    for i in range(1, 4):
+        with open(f"./bots_list{i}.txt") as f:
+            for pair in f.readlines():
+                pair = pair.strip()
+                if pair and pair not in pairs:
+                    pairs.append(pair)
+    return pairs
+
+
+def backtestPair(coin):
+    """Report row of one pair's backtest, None if binance has no data for it"""
+    from binance.exceptions import BinanceAPIException
+
+    try:
+        tradingData = getTradingData(coin + quoteCoin)
+    except BinanceAPIException as e:
+        print(coin, e)
+        return None
+    fills, _ = simulateDeals(
+        tradingData["open"].to_numpy(),
+        tradingData["high"].to_numpy(),
+        tradingData["low"].to_numpy(),
+        0,
+    )
+    if len(fills) == 0:
+        return [coin, 0, 0, 0, 0]
+    deal = np.cumsum(fills["type"] == BASE_ORDER) - 1
+    buys = fills["type"] != TAKE_PROFIT
+    safetys = np.bincount(deal[fills["type"] == SAFETY_ORDER], minlength=deal[-1] + 1)
+    capital = np.bincount(deal[buys], weights=fills["volume"][buys])
+    return [
+        coin,
+        fills["profit"].sum(),
+        np.count_nonzero(fills["type"] == TAKE_PROFIT),
+        safetys.max(),
+        capital.max(),
+    ]
+
+
+def backtestPairs(workers=None):
+    pairs = getListedPairs()
+    # recorded calls and metrics are only kept by this process, use threads then
+    threads = archive.mode == "record" or metrics.enabled
+    with (ThreadPool if threads else Pool)(workers) as pool:
+        rows = list(
+            tqdm(
+                pool.imap_unordered(backtestPair, pairs),
+                total=len(pairs),
+                desc="Backtesting",
+                disable=None,
+            )
+        )
+    df = pd.DataFrame(
+        [row for row in rows if row is not None],
+        columns=["Pair", "Profit", "Deals", "Deepest Safety", "Max Capital"],
+    )
+    df = df.sort_values(by=["Profit"], ascending=False)
+    df.reset_index(inplace=True, drop=True)
+    with pd.option_context("display.max_rows", None, "display.max_columns", None):
+        print(df)
+    print(df["Profit"].sum())
+
+
+def findNextFill(lows, highs, start, safetyOrderPrice, takeProfitOrderPrice):
+    """First row from start that reaches either order price, len(lows) if none does
+
+    Scans in doubling blocks so quiet stretches cost a few array compares.
+    """
+    block = 256
+    while start < len(lows):
+        end = min(start + block, len(lows))
+        hits = np.flatnonzero(
+            (lows[start:end] <= safetyOrderPrice)
+            | (highs[start:end] >= takeProfitOrderPrice)
+        )
+        if len(hits):
+            return start + hits[0]
+        start = end
+        block *= 2
+    return len(lows)
+
+
+class DealSimulator:
+    """State of the DCA bot between candles, see simulateDeals"""
+
+    def __init__(self, funds):
+        self.funds = funds
+        self.fundsBeforeBaseOrder = funds
+        self.fills = []
+
+    def baseOrder(self, row, price):
+        self.coin = baseOrderVolume / price
+        self.funds -= baseOrderVolume
+        self.fills.append((row, BASE_ORDER, price, baseOrderVolume, self.coin, 0))
+        self.buyPricesSum = price
+        self.buyPricesCount = 1
+        self.nextSafetyOrderPrice = price * safetyOrderPriceDeviation
+        self.nextSafetyOrderVolume = firstSafetyOrderVolume
+        self.takeProfitOrderPrice = price * takeProfitPercentage
+
+    def safetyOrder(self, row):
+        safetyCoin = self.nextSafetyOrderVolume / self.nextSafetyOrderPrice
+        self.coin += safetyCoin
+        self.funds -= self.nextSafetyOrderVolume
+        self.fills.append(
+            (
+                row,
+                SAFETY_ORDER,
+                self.nextSafetyOrderPrice,
+                self.nextSafetyOrderVolume,
+                safetyCoin,
+                0,
+            )
+        )
+        self.buyPricesSum += self.nextSafetyOrderPrice
+        self.buyPricesCount += 1
+        avgBuyPrice = self.buyPricesSum / self.buyPricesCount
+        self.nextSafetyOrderPrice *= safetyOrderPriceDeviation
+        self.nextSafetyOrderVolume *= safetyOrderVolumeDeviation
+        self.takeProfitOrderPrice = avgBuyPrice * takeProfitPercentage
+
+    def takeProfit(self, row):
+        self.funds += self.coin * self.takeProfitOrderPrice
+        self.fills.append(
+            (
+                row,
+                TAKE_PROFIT,
+                self.takeProfitOrderPrice,
+                self.coin * self.takeProfitOrderPrice,
+                self.coin,
+                self.funds - self.fundsBeforeBaseOrder,
+            )
+        )
+        self.fundsBeforeBaseOrder = self.funds
+        self.baseOrder(row, self.takeProfitOrderPrice)
+
+    def run(self, highs, lows, refine=None, fillRow=None):
+        """Fills the orders the candles reach, as fillRow if given or their row
+
+        refine(row) returns the open, high and low columns of finer candles
+        for a candle that reaches the safety order and the take profit it
+        would leave, those are run instead so the fills happen in the order
+        the price really took.
+        """
+        start = 0
+        while True:
+            row = findNextFill(
+                lows, highs, start, self.nextSafetyOrderPrice, self.takeProfitOrderPrice
+            )
+            if row == len(lows):
+                return
+            start = row + 1
+            if refine is not None and lows[row] <= self.nextSafetyOrderPrice:
+                takeProfitAfterSafety = (
+                    (self.buyPricesSum + self.nextSafetyOrderPrice)
+                    / (self.buyPricesCount + 1)
+                    * takeProfitPercentage
+                )
+                if highs[row] >= takeProfitAfterSafety:
+                    _, finerHighs, finerLows = refine(row)
+                    if len(finerLows):
+                        self.run(finerHighs, finerLows, fillRow=row)
+                        continue
+            if lows[row] <= self.nextSafetyOrderPrice:
+                self.safetyOrder(row if fillRow is None else fillRow)
+            if highs[row] >= self.takeProfitOrderPrice:
+                self.takeProfit(row if fillRow is None else fillRow)
+
+
+def simulateDeals(opens, highs, lows, funds, refine=None):
+    """Runs the DCA bot over open, high and low columns
+
+    Starts a deal at the first open and a new one at every take profit. A
+    candle fills at most one safety order, before its take profit check.
+    Only candles that fill something are visited, and with refine the
+    candles where that order is ambiguous are run on finer candles (see
+    DealSimulator.run). Returns the fills as a fillDtype array and the funds
+    after the last closed deal.
+    """
+    simulator = DealSimulator(funds)
+    if len(opens):
+        simulator.baseOrder(0, float(opens[0]))
+        simulator.run(highs, lows, refine)
+    return np.array(simulator.fills, dtype=fillDtype), simulator.fundsBeforeBaseOrder
+
+
+def getIntrabarCandles(market, granularity, tradingData):
+    """refine callback of simulateDeals loading the 1m candles of a tradingData
+    row, and a function merging the candles it downloaded into the 1m store
+
+    Candles the store doesn't have are downloaded per row and kept in memory,
+    so the store is rewritten once per run rather than once per refined row.
+    """
+    interval = granularityMilliseconds[granularity]
+    openTimes = (tradingData.index - pd.Timestamp(0)) // pd.Timedelta(milliseconds=1)
+    stored, ranges = loadCandleStore(market, "1m")
+    lastOpen = (toMilliseconds(archive.now()) - 60000) // 60000 * 60000
+    empty = {
+        column: np.zeros(0, dtype=candleDtypes[column]) for column in candleColumns
+    }
+    downloads = []
+    refined = {}
+
+    def refine(row):
+        if row not in refined:
+            start = int(openTimes[row])
+            end = min(start + interval - 60000, lastOpen)
+            first = np.searchsorted(stored["open_time"], start, side="left")
+            last = np.searchsorted(stored["open_time"], end, side="right")
+            parts = [{column: stored[column][first:last] for column in candleColumns}]
+            for span in getMissingRanges(ranges, start, end, 60000):
+                pages = [empty, *iterCandlePages(market, "1m", *span)]
+                candles = {
+                    column: np.concatenate([page[column] for page in pages])
+                    for column in candleColumns
+                }
+                downloads.append((span, candles))
+                parts.append(candles)
+            order = np.argsort(
+                np.concatenate([part["open_time"] for part in parts]), kind="stable"
+            )
+            refined[row] = tuple(
+                np.concatenate([part[column] for part in parts])[order]
+                for column in ["open", "high", "low"]
+            )
+        return refined[row]
+
+    def save():
+        if len(downloads):
+            mergeCandles(market, "1m", stored, ranges, downloads)
+
+    return refine, save
+
+
+def sweep(grid=sweepGrid):
+    tradingData = getTradingData()
+    configs = pd.DataFrame(
+        list(itertools.product(*grid.values())), columns=list(grid.keys())
+    )
+    results = simulateSweep(
+        tradingData["open"].to_numpy(),
+        tradingData["high"].to_numpy(),
+        tradingData["low"].to_numpy(),
+        configs,
+    )
+    results = results.sort_values(by=["Profit"], ascending=False)
+    results.reset_index(inplace=True, drop=True)
+    with pd.option_context("display.max_rows", None, "display.max_columns", None):
+        print(results)
+
+
+def simulateSweep(opens, highs, lows, configs):
+    """Runs every row of configs over the candles together in one pass
+
+    Same bot as simulateDeals with each state variable an array over the
+    configs. Only candles where some config fills an order are visited.
+    Unlike simulateDeals no more than maxSafetyOrders safety orders fill per
+    deal. Returns configs with the closed deals' profit, the most capital
+    a deal tied up and the number of closed deals.
+    """
+    baseOrder = configs["baseOrderVolume"].to_numpy(dtype=float)
+    firstSafetyOrder = configs["firstSafetyOrderVolume"].to_numpy(dtype=float)
+    priceDeviation = configs["safetyOrderPriceDeviation"].to_numpy(dtype=float)
+    volumeDeviation = configs["safetyOrderVolumeDeviation"].to_numpy(dtype=float)
+    maxSafetys = configs["maxSafetyOrders"].to_numpy()
+    takeProfit = configs["takeProfitPercentage"].to_numpy(dtype=float)
+
+    profit = np.zeros(len(configs))
+    maxCapital = np.zeros(len(configs))
+    deals = np.zeros(len(configs), dtype=np.int64)
+    if len(opens):
+        price = np.full(len(configs), float(opens[0]))
+        start = 0
+        baseOrders = np.ones(len(configs), dtype=bool)
+        coin = invested = buyPricesSum = np.zeros(len(configs))
+        nextSafetyOrderPrice = nextSafetyOrderVolume = np.zeros(len(configs))
+        takeProfitOrderPrice = np.zeros(len(configs))
+        buyPricesCount = safetys = np.zeros(len(configs), dtype=np.int64)
+        while True:
+            # base orders of new deals
+            coin = np.where(baseOrders, baseOrder / price, coin)
+            invested = np.where(baseOrders, baseOrder, invested)
+            buyPricesSum = np.where(baseOrders, price, buyPricesSum)
+            buyPricesCount = np.where(baseOrders, 1, buyPricesCount)
+            safetys = np.where(baseOrders, 0, safetys)
+            nextSafetyOrderPrice = np.where(
+                baseOrders, price * priceDeviation, nextSafetyOrderPrice
+            )
+            nextSafetyOrderVolume = np.where(
+                baseOrders, firstSafetyOrder, nextSafetyOrderVolume
+            )
+            takeProfitOrderPrice = np.where(
+                baseOrders, price * takeProfit, takeProfitOrderPrice
+            )
+            maxCapital = np.maximum(maxCapital, invested)
+
+            # a config with all its safety orders filled waits for its take profit
+            row = findNextFill(
+                lows,
+                highs,
+                start,
+                np.where(safetys < maxSafetys, nextSafetyOrderPrice, 0).max(),
+                takeProfitOrderPrice.min(),
+            )
+            if row == len(lows):
+                break
+            safetyOrders = (lows[row] <= nextSafetyOrderPrice) & (safetys < maxSafetys)
+            coin += np.where(
+                safetyOrders, nextSafetyOrderVolume / nextSafetyOrderPrice, 0
+            )
+            invested += np.where(safetyOrders, nextSafetyOrderVolume, 0)
+            maxCapital = np.maximum(maxCapital, invested)
+            buyPricesSum += np.where(safetyOrders, nextSafetyOrderPrice, 0)
+            buyPricesCount += safetyOrders
+            safetys += safetyOrders
+            nextSafetyOrderPrice = np.where(
+                safetyOrders,
+                nextSafetyOrderPrice * priceDeviation,
+                nextSafetyOrderPrice,
+            )
+            nextSafetyOrderVolume = np.where(
+                safetyOrders,
+                nextSafetyOrderVolume * volumeDeviation,
+                nextSafetyOrderVolume,
+            )
+            takeProfitOrderPrice = np.where(
+                safetyOrders,
+                buyPricesSum / buyPricesCount * takeProfit,
+                takeProfitOrderPrice,
+            )
+
+            baseOrders = highs[row] >= takeProfitOrderPrice
+            profit += np.where(baseOrders, coin * takeProfitOrderPrice - invested, 0)
+            deals += baseOrders
+            price = takeProfitOrderPrice
+            start = row + 1
+
+    results = configs.copy()
+    results["Profit"] = profit
+    results["Max Capital"] = maxCapital
+    results["Deals"] = deals
+    return results
+
+
 def getNeededUSDTFromSettings(
     baseOrder, safetyOrderSize, maxSafetyOrders, safetyOrderVolumeDeviation
 ):
@@ -97,101 +483,254 @@ def getNeededUSDTFromSettings(
     return needed
 
 
-def getTradingData():
+def getTradingData(market=market):
+    config = getConfig()
     if config.simstartdate is not None and config.simenddate is not None:
         date = config.simstartdate.split("-")
         startDate = datetime(int(date[0]), int(date[1]), int(date[2]))
         if config.simenddate == "now":
-            endDate = datetime.now()
+            endDate = archive.now()
         else:
             date = config.simenddate.split("-")
             endDate = datetime(int(date[0]), int(date[1]), int(date[2]))
     elif config.simstartdate is not None and config.simenddate is None:
         date = config.simstartdate.split("-")
         startDate = datetime(int(date[0]), int(date[1]), int(date[2]))
-        endDate = startDate + timedelta(minutes=(config.granularity / 60) * 300)
+        endDate = startDate + timedelta(minutes=(int(config.granularity) / 60) * 300)
     elif config.simstartdate is None and config.simenddate is not None:
         if config.simenddate == "now":
-            endDate = datetime.now()
+            endDate = archive.now()
         else:
             date = config.simenddate.split("-")
             endDate = datetime(int(date[0]), int(date[1]), int(date[2]))
-        startDate = endDate - timedelta(minutes=(config.granularity / 60) * 300)
+        startDate = endDate - timedelta(minutes=(int(config.granularity) / 60) * 300)
     else:
         raise KeyError("Set start and end date")
 
-    granularity = to_binance_granularity(config.getGranularity())
-    resp = client.get_historical_klines(
-        market,
-        granularity,
-        startDate.isoformat(timespec="milliseconds"),
-        endDate.isoformat(timespec="milliseconds"),
+    granularity = to_binance_granularity(int(config.granularity))
+    candles = getCandles(
+        market, granularity, toMilliseconds(startDate), toMilliseconds(endDate)
     )
-    # convert the API response into a Pandas DataFrame
+
+    # convert the candles into a time series with the date as the index/key
+    tsidx = pd.DatetimeIndex(pd.to_datetime(candles["open_time"], unit="ms"))
     df = pd.DataFrame(
-        resp,
-        columns=[
-            "open_time",
-            "open",
-            "high",
-            "low",
-            "close",
-            "volume",
-            "close_time",
-            "quote_asset_volume",
-            "number_of_trades",
-            "taker_buy_base_asset_volume",
-            "traker_buy_quote_asset_volume",
-            "ignore",
-        ],
+        {
+            "date": tsidx,
+            "low": candles["low"],
+            "high": candles["high"],
+            "open": candles["open"],
+            "close": candles["close"],
+        },
+        index=tsidx,
     )
-    df["market"] = market
-    df["granularity"] = granularity
+    df.index.names = ["ts"]
+    return df
 
-    # binance epoch is too long
-    df["open_time"] = df["open_time"] + 1
-    df["open_time"] = df["open_time"].astype(str)
-    df["open_time"] = df["open_time"].str.replace(r"\d{3}$", "", regex=True)
 
-    SUPPORTED_GRANULARITY = [60, 300, 900, 3600, 21600, 86400]
-    FREQUENCY_EQUIVALENTS = ["T", "5T", "15T", "H", "6H", "D"]
+def toMilliseconds(date: datetime) -> int:
+    # naive dates are UTC, like binance parses them
+    return int((date - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def getMissingRanges(ranges, start, end, interval):
+    """Parts of [start, end] not covered by the sorted disjoint ranges"""
+    missing = []
+    for rangeStart, rangeEnd in ranges:
+        if rangeEnd < start:
+            continue
+        if rangeStart > end:
+            break
+        if rangeStart > start:
+            missing.append((start, rangeStart - interval))
+        start = max(start, rangeEnd + interval)
+    if start <= end:
+        missing.append((start, end))
+    return missing
+
+
+def addRange(ranges, start, end, interval):
+    merged = []
+    for rangeStart, rangeEnd in sorted([*ranges, [start, end]]):
+        if len(merged) and rangeStart <= merged[-1][1] + interval:
+            merged[-1][1] = max(merged[-1][1], rangeEnd)
+        else:
+            merged.append([rangeStart, rangeEnd])
+    return merged
 
-    try:
-        freq = FREQUENCY_EQUIVALENTS[SUPPORTED_GRANULARITY.index(granularity)]
-    except:
-        freq = "D"
 
-    # convert the DataFrame into a time series with the date as the index/key
+def loadCandleStore(market, granularity):
+    """Memory-mapped stored candles of market and the open time ranges they cover"""
+    folder = os.path.join(candleStorePath, f"{market}-{granularity}")
     try:
-        tsidx = pd.DatetimeIndex(
-            pd.to_datetime(df["open_time"], unit="s"), dtype="datetime64[ns]", freq=freq
+        with open(os.path.join(folder, "ranges.json"), "r") as openfile:
+            ranges = json.load(openfile)
+        candles = {
+            column: np.load(os.path.join(folder, f"{column}.npy"), mmap_mode="r")
+            for column in candleColumns
+        }
+    except FileNotFoundError:
+        ranges = []
+        candles = {
+            column: np.zeros(0, dtype=candleDtypes[column]) for column in candleColumns
+        }
+    return candles, ranges
+
+
+def saveCandleStore(market, granularity, segments, ranges):
+    """Writes the time ordered segments of columns as the store of market
+
+    Every column is copied into a memory-mapped file segment by segment so
+    the candles never have to fit in memory at once.
+    """
+    folder = os.path.join(candleStorePath, f"{market}-{granularity}")
+    total = sum(len(segment["open_time"]) for segment in segments)
+    for column in candleColumns:
+        tmpPath = os.path.join(folder, f"{column}.{os.getpid()}.npy")
+        saved = np.lib.format.open_memmap(
+            tmpPath, mode="w+", dtype=segments[0][column].dtype, shape=(total,)
         )
-        df.set_index(tsidx, inplace=True)
-        df = df.drop(columns=["open_time"])
-        df.index.names = ["ts"]
-        df["date"] = tsidx
-    except ValueError:
-        tsidx = pd.DatetimeIndex(
-            pd.to_datetime(df["open_time"], unit="s"), dtype="datetime64[ns]"
+        offset = 0
+        for segment in segments:
+            saved[offset : offset + len(segment[column])] = segment[column]
+            offset += len(segment[column])
+        saved.flush()
+        del saved
+        os.replace(tmpPath, os.path.join(folder, f"{column}.npy"))
+    # ranges last so a crash never claims candles that weren't written
+    tmpPath = os.path.join(folder, f"ranges.{os.getpid()}.json")
+    with open(tmpPath, "w") as outfile:
+        json.dump(ranges, outfile)
+    os.replace(tmpPath, os.path.join(folder, "ranges.json"))
+
+
+def iterCandlePages(market, granularity, start, end):
+    """Candles opening in [start, end] as numeric columns, one binance page at a time"""
+    interval = granularityMilliseconds[granularity]
+    while start <= end:
+        # ['Open Time', 'Open', 'High', 'Low', 'Close', 'Volume', 'Close Time', '', '', '', '', '']
+        page = getClient().get_klines(
+            symbol=market,
+            interval=granularity,
+            startTime=start,
+            endTime=end + interval - 1,
+            limit=1000,
         )
-        df.set_index(tsidx, inplace=True)
-        df = df.drop(columns=["open_time"])
-        df.index.names = ["ts"]
-        df["date"] = tsidx
-
-    # re-order columns
-    df = df[["date", "low", "high", "open", "close"]]
-
-    # correct column types
-    df["low"] = df["low"].astype(float)
-    df["high"] = df["high"].astype(float)
-    df["open"] = df["open"].astype(float)
-    df["close"] = df["close"].astype(float)
-
-    # reset pandas dataframe index
-    df.reset_index()
-    return df
+        if len(page) == 0:
+            break
+        values = np.array([kline[1:6] for kline in page], dtype=float)
+        candles = {column: values[:, i] for i, column in enumerate(candleColumns[1:])}
+        candles["open_time"] = np.fromiter(
+            (kline[0] for kline in page), dtype=np.int64, count=len(page)
+        )
+        yield candles
+        start = page[-1][0] + interval
+
+
+def downloadCandles(market, granularity, start, end):
+    """Candles opening in [start, end] as memory-mapped columns
+
+    Pages are appended to raw column files as they arrive so only one page
+    is ever held in memory. The files are named .part, remove them once the
+    candles are saved.
+    """
+    folder = os.path.join(candleStorePath, f"{market}-{granularity}")
+    paths = {
+        column: os.path.join(folder, f"{column}.{start}.{os.getpid()}.part")
+        for column in candleColumns
+    }
+    for path in paths.values():
+        open(path, "wb").close()
+    count = 0
+    for page in iterCandlePages(market, granularity, start, end):
+        for column in candleColumns:
+            with open(paths[column], "ab") as outfile:
+                page[column].tofile(outfile)
+        count += len(page["open_time"])
+    if count == 0:
+        return {
+            column: np.zeros(0, dtype=candleDtypes[column]) for column in candleColumns
+        }
+    return {
+        column: np.memmap(paths[column], dtype=candleDtypes[column], mode="r")
+        for column in candleColumns
+    }
+
+
+def mergeCandles(market, granularity, candles, ranges, downloads):
+    """Saves the stored candles and ranges with the downloaded (span, candles)
+    of ranges the store didn't cover"""
+    interval = granularityMilliseconds[granularity]
+    os.makedirs(os.path.join(candleStorePath, f"{market}-{granularity}"), exist_ok=True)
+    # stored candles never fall in a missing range, so cutting them at
+    # the missing ranges keeps the segments in time order
+    segments = []
+    done = 0
+    for span, downloaded in sorted(downloads, key=lambda download: download[0]):
+        cut = np.searchsorted(candles["open_time"], span[0])
+        segments.append({column: candles[column][done:cut] for column in candleColumns})
+        segments.append(downloaded)
+        ranges = addRange(ranges, *span, interval)
+        done = cut
+    segments.append({column: candles[column][done:] for column in candleColumns})
+    saveCandleStore(market, granularity, segments, ranges)
+
+
+def getCandles(market, granularity, start, end):
+    """Candles of market opening in [start, end] as numeric columns
+
+    Served from the local store under candleStorePath, only the ranges it
+    doesn't cover yet are downloaded and merged into it. Candles that are
+    still open aren't stored or returned.
+    """
+    interval = granularityMilliseconds[granularity]
+    start = -(-int(start) // interval) * interval
+    end = min(int(end), toMilliseconds(archive.now()) - interval)
+    end = end // interval * interval
+    candles, ranges = loadCandleStore(market, granularity)
+    missing = getMissingRanges(ranges, start, end, interval)
+    if len(missing):
+        folder = os.path.join(candleStorePath, f"{market}-{granularity}")
+        os.makedirs(folder, exist_ok=True)
+        downloads = [
+            (span, downloadCandles(market, granularity, *span)) for span in missing
+        ]
+        mergeCandles(market, granularity, candles, ranges, downloads)
+        for name in os.listdir(folder):
+            if name.endswith(f".{os.getpid()}.part"):
+                os.remove(os.path.join(folder, name))
+        candles, ranges = loadCandleStore(market, granularity)
+
+    first = np.searchsorted(candles["open_time"], start, side="left")
+    last = np.searchsorted(candles["open_time"], end, side="right")
+    return {column: candles[column][first:last] for column in candleColumns}
 
 
 if __name__ == "__main__":
-    main()
+    archive.configure()
+    metrics.configure()
+    sweepMode = False
+    pairsMode = False
+    refine = False
+    workers = None
+    for arg in sys.argv[1:]:
+        if not arg.startswith("--"):
+            raise KeyError("Unknown option")
+        key, _, val = arg[2:].partition("=")
+        if key == "sweep":
+            sweepMode = True
+        elif key == "pairs":
+            pairsMode = True
+        elif key == "workers":
+            workers = int(val)
+        elif key == "refine":
+            refine = True
+        else:
+            raise KeyError(f"Unknown option '{arg}'")
+
+    if sweepMode:
+        sweep()
+    elif pairsMode:
+        backtestPairs(workers)
+    else:
+        main(refine)
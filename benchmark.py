@@ -0,0 +1,329 @@
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+
+scriptsPath = os.path.dirname(os.path.abspath(__file__))
+baselinePath = os.path.join(scriptsPath, "benchmark-data", "baseline.json")
+# a run slower or bigger than this fraction over the baseline is a regression
+tolerance = 0.2
+repeat = 5
+
+fixtureStart = 1609459200000  # 2021-01-01
+fixtureCandles = 30 * 24 * 60
+fixtureOrders = 20000
+fixtureDeals = 20000
+
+
+def loadScript(name, fileName):
+    """One of the scripts as a module, their file names aren't importable"""
+    sys.path.insert(0, scriptsPath)
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(scriptsPath, fileName)
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeBinance:
+    """Local stand-in for the Binance endpoints the scripts use, over a seeded
+    random walk of 1m candles and a history of filled orders"""
+
+    def __init__(self):
+        rng = np.random.default_rng(0)
+        self.openTimes = fixtureStart + 60000 * np.arange(fixtureCandles)
+        close = 0.3 * np.exp(np.cumsum(rng.normal(0, 0.002, fixtureCandles)))
+        open_ = np.concatenate([[0.3], close[:-1]])
+        high = np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.001, len(close))))
+        low = np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.001, len(close))))
+        self.klines = [
+            [int(t), str(o), str(h), str(l), str(c), "1000", int(t) + 59999]
+            for t, o, h, l, c in zip(self.openTimes, open_, high, low, close)
+        ]
+        quantities = rng.uniform(1, 100, fixtureOrders)
+        prices = rng.uniform(0.1, 1, fixtureOrders)
+        self.orders = [
+            {
+                "orderId": i + 1,
+                "status": "FILLED",
+                "executedQty": f"{qty:.2f}",
+                "cummulativeQuoteQty": f"{qty * price:.4f}",
+                "side": "BUY" if i % 3 else "SELL",
+                "updateTime": fixtureStart + i * 60000,
+                "time": fixtureStart + i * 60000,
+                "price": f"{price:.4f}",
+            }
+            for i, (qty, price) in enumerate(zip(quantities, prices))
+        ]
+
+    def get_klines(self, symbol, interval, startTime=None, endTime=None, limit=500):
+        step = {"1m": 1, "5m": 5, "15m": 15, "1h": 60, "6h": 360, "1d": 1440}[interval]
+        first = max(-(-(startTime - fixtureStart) // 60000), 0)
+        first = -(-first // step) * step
+        last = np.searchsorted(self.openTimes, endTime, side="right")
+        return self.klines[first:last:step][:limit]
+
+    def get_all_orders(self, symbol, orderId=0, limit=500):
+        return self.orders[max(orderId - 1, 0) :][:limit]
+
+
+class FakeP3cw:
+    """Local stand-in for the 3Commas deals endpoint, newest closed first"""
+
+    def __init__(self):
+        rng = np.random.default_rng(1)
+        self.deals = [
+            {
+                "id": i,
+                "bot_id": 1,
+                "pair": f"USDT_C{i % 30}",
+                "closed_at": time.strftime(
+                    "%Y-%m-%dT%H:%M:%S.000Z",
+                    time.gmtime(time.time() - (fixtureDeals - i) * 600),
+                ),
+                "actual_profit": str(profit),
+                "actual_usd_profit": str(profit),
+                "final_profit": str(profit),
+                "usd_final_profit": str(profit),
+            }
+            for i, profit in enumerate(rng.uniform(0, 2, fixtureDeals))
+        ][::-1]
+
+    def request(self, entity, action="", action_id=None, payload=None):
+        offset = payload.get("offset", 0)
+        return {}, self.deals[offset : offset + payload["limit"]]
+
+
+def getBenchmarks():
+    """name -> (setup, run, unit, work), run(setup()) is timed, work is
+    the number of units it processes. The optimizer prunes most of its grid,
+    so it is measured in whole searches rather than candidates."""
+    tc = loadScript("threecommas", "3commas.py")
+    bt = loadScript("backtest", "backtest.py")
+    pf = loadScript("portfolio", "binance-portfolio.py")
+    binance = FakeBinance()
+    bt.client = pf.client = binance
+    bt.config = pf.config = tc.config = SimpleNamespace(
+        granularity="60",
+        simstartdate="2021-01-01",
+        simenddate="2021-01-30",
+        discordHook="",
+    )
+    tc.p3cw = FakeP3cw()
+    candles = 29 * 24 * 60
+
+    def removeCandleStore():
+        shutil.rmtree(bt.candleStorePath, ignore_errors=True)
+
+    def removeStore(path):
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    def runQuietly(function, *args):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return function(*args)
+
+    return {
+        "getBestBotSettings": (
+            tc.getLadderTables,
+            lambda _: tc.getBestBotSettings(1000, 10, 7),
+            "searches",
+            1,
+        ),
+        "getBounceFromSettings": (
+            lambda: None,
+            lambda _: [
+                tc.getBounceFromSettings(so, 20, 1.5, 1.2, 1.5, 1.1)
+                for so in np.arange(10, 60, 0.01)
+            ],
+            "calls",
+            len(np.arange(10, 60, 0.01)),
+        ),
+        "getTradingData download": (
+            removeCandleStore,
+            lambda _: bt.getTradingData(),
+            "candles",
+            candles,
+        ),
+        "getTradingData store": (
+            lambda: bt.getTradingData(),
+            lambda _: bt.getTradingData(),
+            "candles",
+            candles,
+        ),
+        "backtest main": (
+            lambda: bt.getTradingData(),
+            lambda _: runQuietly(bt.main),
+            "candles",
+            candles,
+        ),
+        "getAllOrders": (
+            lambda: removeStore(pf.historyPath),
+            lambda _: pf.getAllOrders("DOGE"),
+            "orders",
+            fixtureOrders,
+        ),
+        "getCostBasis": (
+            lambda: {"DOGE": pf.getAllOrders("DOGE")},
+            lambda orders: pf.getCostBasis(orders),
+            "orders",
+            fixtureOrders,
+        ),
+        "syncDeals": (
+            lambda: removeStore(tc.dealsPath),
+            lambda _: tc.syncDeals(),
+            "deals",
+            fixtureDeals,
+        ),
+        "printProfits": (
+            tc.syncDeals,
+            lambda _: runQuietly(
+                tc.printProfits, [f"USDT_C{i}" for i in range(30)], 365
+            ),
+            "deals",
+            fixtureDeals,
+        ),
+    }
+
+
+# scripts whose import time is measured, see timeStartup
+startupScripts = ["3commas.py", "backtest.py", "binance-portfolio.py"]
+# client libraries importing a script must not pull in, they cost a second
+lazyModules = ["binance", "py3cw"]
+startupCode = """
+import importlib.util, os, resource, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {scriptsPath!r})
+spec = importlib.util.spec_from_file_location("script", {path!r})
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+seconds = time.perf_counter() - start
+eager = [name for name in {lazyModules!r} if name in sys.modules]
+# ru_maxrss carries over from the forked benchmark process, VmHWM starts at exec
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if os.path.exists("/proc/self/status"):
+    with open("/proc/self/status") as f:
+        peak = next(int(line.split()[1]) for line in f if line.startswith("VmHWM"))
+print(seconds, peak * 1024, *eager)
+"""
+
+
+def timeStartup(fileName):
+    """Best import time of a script in a fresh interpreter over repeat runs,
+    the peak RSS of that interpreter and the lazy modules the import loaded"""
+    code = startupCode.format(
+        scriptsPath=scriptsPath,
+        path=os.path.join(scriptsPath, fileName),
+        lazyModules=lazyModules,
+    )
+    seconds = float("inf")
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        ).stdout.split()
+        seconds = min(seconds, float(output[0]))
+    return seconds, int(output[1]), output[2:]
+
+
+def runBenchmark(setup, run):
+    """Best time of repeat runs, then peak traced memory of one more"""
+    seconds = float("inf")
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        seconds = min(seconds, time.perf_counter() - start)
+    state = setup()
+    tracemalloc.start()
+    run(state)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def main(only=None, save=False):
+    baseline = {}
+    if os.path.exists(baselinePath):
+        with open(baselinePath) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+
+    def report(name, seconds, peak, unit, work):
+        results[name] = {"throughput": work / seconds, "peak": peak, "unit": unit}
+        change = ""
+        if name in baseline:
+            speed = results[name]["throughput"] / baseline[name]["throughput"] - 1
+            memory = peak / max(baseline[name]["peak"], 1) - 1
+            change = f"{speed:+7.1%} {memory:+7.1%} MB"
+            if speed < -tolerance or memory > tolerance:
+                regressions.append(name)
+                change += " !"
+        print(
+            f"{name:32} {work / seconds:>15,.1f} {unit + '/s':<10}"
+            f" {peak / 2**20:>9.1f} {change:>18}"
+        )
+
+    print(f"{'':32} {'throughput':>26} {'peak MB':>9} {'vs baseline':>18}")
+    # the scripts keep their data under relative paths, run them in a scratch folder
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as folder:
+        os.chdir(folder)
+        os.makedirs("portfolio-data")
+        for name, (setup, run, unit, work) in getBenchmarks().items():
+            if only is None or name in only:
+                seconds, peak = runBenchmark(setup, run)
+                report(name, seconds, peak, unit, work)
+        # the startup budget of user facing commands, peak is the whole process
+        for fileName in startupScripts:
+            name = f"startup {fileName}"
+            if only is None or name in only:
+                seconds, peak, eager = timeStartup(fileName)
+                report(name, seconds, peak, "starts", 1)
+                if len(eager):
+                    print(f"  importing {fileName} loaded {', '.join(eager)}")
+                    regressions.append(name)
+        os.chdir(scriptsPath)
+
+    if save:
+        baseline.update(results)
+        os.makedirs(os.path.dirname(baselinePath), exist_ok=True)
+        with open(baselinePath, "w") as f:
+            json.dump(baseline, f, indent=4)
+        print(f"Saved baseline to {baselinePath}")
+    elif len(regressions):
+        print(f"Regressed over {tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    only = None
+    save = False
+    for arg in sys.argv[1:]:
+        if not arg.startswith("--"):
+            raise KeyError("Unknown option")
+        key, _, val = arg[2:].partition("=")
+        if key == "save":
+            save = True
+        elif key == "only":
+            only = val.split(",")
+        elif key == "tolerance":
+            tolerance = float(val)
+        elif key == "repeat":
+            repeat = int(val)
+        else:
+            raise KeyError(f"Unknown option '{arg}'")
+
+    main(only, save)
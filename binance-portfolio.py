@@ -1,59 +1,89 @@
 import json
 import logging
 import math
+import os
+import sqlite3
+import sys
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
-import mezmorize
 import numpy as np
 import pandas as pd
-from binance.client import BinanceAPIException, Client
 from pandas.core.frame import DataFrame
+from tqdm import tqdm
 
+import archive
+import metrics
+from backtest import getCandles, granularityMilliseconds, toMilliseconds
 from config import Config
 
 pd.set_option(
     "display.float_format",
     lambda x: x
-    if math.isnan(x)
+    if not math.isfinite(x)
     else ("%.0f" if int(x) == x else "%0.0f" if abs(x) < 0.0001 else "%.4f")
     % (-x if -0.0001 <= x < 0 else x),
 )
-config = Config()
-client = Client(
-    config.binance_key, config.binance_secret, {"verify": False, "timeout": 20}
-)
+config = None
+client = None
 extraRows = ["Lost", "Withdraws"]
 shownRows = ["BTC", "ETH", "LTC", "USDT", "BNB"]
 tradefees = 0.00075
-logging.basicConfig(
-    filename="./portfolio-data/history.log",
-    format="%(message)s",
-    # datefmt="%d-%m-%Y %H:%M:%S",
-    filemode="a",
-    level=logging.DEBUG,
-    force=True,
-    encoding="utf-8",
-)
-logging.getLogger("urllib3").setLevel(logging.WARNING)
-try:
-    with open("./portfolio-data/prices.json", "r") as openfile:
-        prices = json.load(openfile)
-except FileNotFoundError:
-    prices = {}
-
-logging.info("")
-logging.info("=" * 50)
-logging.info((" " * 15) + datetime.now().strftime("%d-%m-%Y %H:%M:%S"))
-logging.info("=" * 50)
+pricesPath = "./portfolio-data/prices.sqlite"
+pricesCacheSize = 10000
+pricesDB = None
+pricesCache = OrderedDict()
+historyPath = "./portfolio-data/history.sqlite"
+# order pages are retried with exponential backoff from syncBackoff seconds
+syncRetries = 4
+syncBackoff = 3
+logger = None
+
+
+def getConfig():
+    global config
+    if config is None:
+        config = Config()
+    return config
+
+
+def getClient():
+    global client
+    if client is None:
+        client = archive.getBinanceClient(getConfig)
+    return client
+
+
+def getLogger():
+    """history.log, opened with a run header on the first log"""
+    global logger
+    if logger is None:
+        logging.basicConfig(
+            filename="./portfolio-data/history.log",
+            format="%(message)s",
+            # datefmt="%d-%m-%Y %H:%M:%S",
+            filemode="a",
+            level=logging.DEBUG,
+            force=True,
+            encoding="utf-8",
+        )
+        logging.getLogger("urllib3").setLevel(logging.WARNING)
+        logger = logging.getLogger()
+        logger.info("")
+        logger.info("=" * 50)
+        logger.info((" " * 15) + datetime.now().strftime("%d-%m-%Y %H:%M:%S"))
+        logger.info("=" * 50)
+    return logger
 
 
 def log(string="", error=False):
     print(string)
     if error:
-        logging.error("ERROR: " + str(string))
+        getLogger().error("ERROR: " + str(string))
     else:
-        logging.info(string)
+        getLogger().info(string)
 
 
 def fullPrint(df):
@@ -61,16 +91,88 @@ def fullPrint(df):
         log(df)
 
 
+def getPricesDB():
+    """Saved prices indexed by (symbol, time), imported from prices.json when empty"""
+    global pricesDB
+    if pricesDB is None:
+        pricesDB = sqlite3.connect(pricesPath)
+        pricesDB.execute("PRAGMA journal_mode=WAL")
+        pricesDB.execute(
+            """CREATE TABLE IF NOT EXISTS prices (
+                symbol TEXT, time INTEGER, price REAL, PRIMARY KEY (symbol, time)
+            ) WITHOUT ROWID"""
+        )
+        if pricesDB.execute("SELECT 1 FROM prices LIMIT 1").fetchone() is None:
+            try:
+                with open("./portfolio-data/prices.json", "r") as openfile:
+                    prices = json.load(openfile)
+            except FileNotFoundError:
+                prices = {}
+            with pricesDB:
+                pricesDB.executemany(
+                    "INSERT OR REPLACE INTO prices VALUES (?, ?, ?)",
+                    (
+                        (symbol, int(endTime), price)
+                        for symbol, symbolPrices in prices.items()
+                        for endTime, price in symbolPrices.items()
+                    ),
+                )
+    return pricesDB
+
+
+def cachePrice(symbol: str, endTime: int, price: float):
+    pricesCache[(symbol, endTime)] = price
+    pricesCache.move_to_end((symbol, endTime))
+    if len(pricesCache) > pricesCacheSize:
+        pricesCache.popitem(last=False)
+
+
+def getSavedPrice(symbol: str, endTime: int):
+    if (symbol, endTime) in pricesCache:
+        pricesCache.move_to_end((symbol, endTime))
+        return pricesCache[(symbol, endTime)]
+    row = (
+        getPricesDB()
+        .execute(
+            "SELECT price FROM prices WHERE symbol = ? AND time = ?", (symbol, endTime)
+        )
+        .fetchone()
+    )
+    if row is None:
+        return None
+    cachePrice(symbol, endTime, row[0])
+    return row[0]
+
+
+def savePrice(symbol: str, endTime: int, price: float):
+    with getPricesDB():
+        getPricesDB().execute(
+            "INSERT OR REPLACE INTO prices VALUES (?, ?, ?)", (symbol, endTime, price)
+        )
+    cachePrice(symbol, endTime, price)
+
+
 def getPriceAtTime(symbol: str, endTime=time.time() * 1000, save=False):
     if symbol in ["USDT", *extraRows]:
         return 1
     if "timestamp" in dir(endTime):
         endTime = endTime.timestamp() * 1000
     endTime = int(endTime)
-    if symbol in prices and str(endTime) in prices[symbol]:
-        return prices[symbol][str(endTime)]
+    price = getSavedPrice(symbol, endTime)
+    if price is not None:
+        return price
+    price = fetchPrice(symbol, endTime)
+    if save:
+        # log(f"Saving price for {symbol} at {endTime}")
+        savePrice(symbol, endTime, price)
+    return price
+
+
+def fetchPrice(symbol: str, endTime: int):
+    """Close of the 1m candle of symbol at endTime from binance, never touches
+    the prices store so it can run on any thread"""
     # ['Open Time', 'Open', 'High', 'Low', 'Close', 'Volume', 'Close Time', '', '', '', '', '']
-    res = client.get_klines(
+    res = getClient().get_klines(
         symbol=symbol + "USDT",
         interval="1m",
         limit=1,
@@ -78,16 +180,39 @@ def getPriceAtTime(symbol: str, endTime=time.time() * 1000, save=False):
     )
     if len(res) == 0:
         log(f"{symbol} {endTime} {res}", error=False)
-    if save:
-        # log(f"Saving price for {symbol} at {endTime}")
-        if not symbol in prices:
-            prices[symbol] = {}
-        prices[symbol][str(endTime)] = float(res[0][4])
     return float(res[0][4])
 
 
+def getCurrentPrices(symbols):
+    """USDT price of every symbol now, from one bulk ticker request
+
+    Symbols without a ticker fall back to their latest 1m candle, fetched
+    concurrently. Current prices are never saved, so the prices store isn't
+    used.
+    """
+    tickers = {
+        ticker["symbol"]: float(ticker["price"])
+        for ticker in getClient().get_all_tickers()
+    }
+    currentPrices = {}
+    missing = []
+    for symbol in symbols:
+        if symbol in ["USDT", *extraRows]:
+            currentPrices[symbol] = 1
+        elif symbol + "USDT" in tickers:
+            currentPrices[symbol] = tickers[symbol + "USDT"]
+        else:
+            missing.append(symbol)
+    endTime = int(time.time() * 1000)
+    if len(missing):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            prices = executor.map(lambda symbol: fetchPrice(symbol, endTime), missing)
+            currentPrices.update(zip(missing, prices))
+    return currentPrices
+
+
 def getBalances():
-    accountInfo = client.get_account()
+    accountInfo = getClient().get_account()
     balances = pd.DataFrame(accountInfo["balances"])
     balances[["free", "locked"]] = balances[["free", "locked"]].apply(pd.to_numeric)
     balances = balances[(balances["free"] > 0) | (balances["locked"] > 0)]
@@ -146,16 +271,17 @@ def main():
     #     )
 
     # Balances coins
+    currentPrices = getCurrentPrices(balances["asset"])
+    totals = balances.set_index("asset")["total"]
     balanceSum = 0
     for symbol in portfolio.index:
-        balance = balances.loc[balances["asset"] == symbol]
-        if len(balance) == 0:
+        if symbol not in totals.index:
             continue
-        total = balance["total"].values[0]
+        total = totals[symbol]
         if symbol in extraRows or symbol == "USDT":
             balanceSum += total
             continue
-        usd = total * getPriceAtTime(symbol)
+        usd = total * currentPrices[symbol]
         portfolio.loc[symbol]["Amount"] = total
         portfolio.loc[symbol]["USDT"] = usd
         balanceSum += usd
@@ -176,72 +302,383 @@ def main():
     portfolio.loc["Profit"] = balanceSum - p2pSum["USDT"]
     fullPrint(portfolio)
 
-    json_object = json.dumps(prices, indent=4)
-    with open("./portfolio-data/prices.json", "w+") as outfile:
-        outfile.write(json_object)
+
+def getHistoryDB():
+    """Synced orders of every symbol and the order id their next sync starts at"""
+    db = sqlite3.connect(historyPath, timeout=60)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS orders (
+            symbol TEXT,
+            orderId INTEGER,
+            status TEXT,
+            executedQty REAL,
+            cummulativeQuoteQty REAL,
+            side TEXT,
+            updateTime INTEGER,
+            time INTEGER,
+            price REAL,
+            PRIMARY KEY (symbol, orderId)
+        ) WITHOUT ROWID"""
+    )
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS syncs (
+            symbol TEXT PRIMARY KEY, nextOrderId INTEGER
+        )"""
+    )
+    return db
+
+
+def getP2P():
+    """p2p.json, with its columns even when it has no rows"""
+    p2p: DataFrame = pd.read_json("./portfolio-data/p2p.json", convert_dates=["Time"])
+    if len(p2p) == 0:
+        p2p = pd.DataFrame(
+            {"Time": pd.to_datetime([]), "Symbol": [], "USDT": [], "Bought At": []}
+        )
+    return p2p
+
+
+def getHoldings(granularity="1d"):
+    """Amount of every asset held at the end of each period, replayed from the
+    synced orders and p2p.json"""
+    period = pd.Timedelta(milliseconds=granularityMilliseconds[granularity])
+    db = getHistoryDB()
+    orders = pd.read_sql_query(
+        """SELECT symbol, side, executedQty, cummulativeQuoteQty, time
+        FROM orders WHERE executedQty > 0""",
+        db,
+    )
+    db.close()
+    p2p = getP2P()
+
+    sides = np.where(orders["side"] == "BUY", 1, -1)
+    times = pd.to_datetime(orders["time"], unit="ms")
+    quote = orders["cummulativeQuoteQty"]
+    changes = pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "time": times,
+                    "asset": orders["symbol"],
+                    "amount": sides * orders["executedQty"],
+                }
+            ),
+            pd.DataFrame(
+                {
+                    "time": times,
+                    "asset": "USDT",
+                    "amount": -sides * quote - quote * tradefees,
+                }
+            ),
+            pd.DataFrame(
+                {
+                    "time": p2p["Time"],
+                    "asset": p2p["Symbol"],
+                    "amount": p2p["USDT"] / p2p["Bought At"],
+                }
+            ),
+        ]
+    )
+    changes["time"] = changes["time"].dt.floor(period)
+    holdings = changes.pivot_table(
+        index="time", columns="asset", values="amount", aggfunc="sum", fill_value=0
+    )
+    return holdings.cumsum()
+
+
+def getEquityCurve(start=None, end=None, granularity="1d"):
+    """Value, p2p deposits and profit of the portfolio at the end of each period
+
+    Holdings and deposits are replayed from the synced orders and p2p.json,
+    prices come from the backtest candle store, one price series per asset.
+    """
+    from binance.exceptions import BinanceAPIException
+
+    period = pd.Timedelta(milliseconds=granularityMilliseconds[granularity])
+    holdings = getHoldings(granularity)
+    p2p = getP2P()
+    deposits = p2p.groupby(p2p["Time"].dt.floor(period))["USDT"].sum().cumsum()
+
+    if start is None and len(holdings) == 0:
+        return pd.DataFrame(columns=["Equity", "P2P In", "Profit"], dtype=float)
+    start = holdings.index[0] if start is None else pd.Timestamp(start)
+    end = pd.Timestamp(archive.now() if end is None else end)
+    index = pd.date_range(start.floor(period), end.floor(period), freq=period)
+    holdings = holdings.reindex(index, method="ffill").fillna(0)
+
+    prices = pd.DataFrame(1.0, index=index, columns=holdings.columns)
+    for asset in holdings.columns:
+        if asset == "USDT" or asset in extraRows:
+            continue
+        try:
+            candles = getCandles(
+                asset + "USDT",
+                granularity,
+                toMilliseconds(index[0].to_pydatetime()),
+                toMilliseconds(index[-1].to_pydatetime()),
+            )
+        except BinanceAPIException as e:
+            log(f"{asset} {e}", error=True)
+            prices[asset] = 0
+            continue
+        closes = pd.Series(
+            candles["close"], index=pd.to_datetime(candles["open_time"], unit="ms")
+        )
+        prices[asset] = closes.reindex(index, method="ffill").fillna(0)
+
+    curve = pd.DataFrame(index=index)
+    curve["Equity"] = (holdings * prices).sum(axis=1)
+    curve["P2P In"] = deposits.reindex(index, method="ffill").fillna(0)
+    curve["Profit"] = curve["Equity"] - curve["P2P In"]
+    return curve
 
 
 def getAllOrders(symbol: str) -> DataFrame:
-    resp = None
-    try:
-        df = pd.read_json(f"./portfolio-data/history/{symbol}.json")
-    except:
-        df = pd.DataFrame()
-    if len(df) == 0:
-        while True:
-            try:
-                resp = client.get_all_orders(symbol=symbol + "USDT", limit=1000)
-            except BinanceAPIException as e:
-                print(e)
-                time.sleep(3)
-                continue
-            break
-        df = pd.DataFrame(resp)
-    while resp is None or len(resp) > 0:
-        while True:
+    from binance.exceptions import BinanceAPIException
+    from requests.exceptions import RequestException
+
+    db = getHistoryDB()
+    sync = db.execute(
+        "SELECT nextOrderId FROM syncs WHERE symbol = ?", (symbol,)
+    ).fetchone()
+    nextOrderId = 0 if sync is None else sync[0]
+    pages = []
+    while True:
+        for attempt in range(syncRetries + 1):
+            if attempt:
+                time.sleep(syncBackoff * 2 ** (attempt - 1))
             try:
-                resp = client.get_all_orders(
-                    symbol=symbol + "USDT", endTime=df.loc[0]["time"] - 1, limit=1000
+                resp = getClient().get_all_orders(
+                    symbol=symbol + "USDT", orderId=nextOrderId, limit=1000
                 )
-            except BinanceAPIException as e:
+                break
+            except (BinanceAPIException, RequestException) as e:
+                # no such market won't change, and retrying past the request
+                # weight limit (-1003, then 418) only extends the ban
+                if attempt == syncRetries or (
+                    isinstance(e, BinanceAPIException)
+                    and (e.code in [-1121, -1003] or e.status_code == 418)
+                ):
+                    raise
                 print(e)
-                time.sleep(3)
-                continue
+        pages.append(resp)
+        if len(resp) < 1000:
             break
-        df = df.append(pd.DataFrame(resp))
-        df.sort_values(by=["time"], inplace=True)
-        df.reset_index(inplace=True, drop=True)
-    if len(df) == 0:
-        return df
-
-    df = df[
-        ["executedQty", "cummulativeQuoteQty", "side", "updateTime", "time", "price"]
+        nextOrderId = resp[-1]["orderId"] + 1
+    orders = [order for page in pages for order in page]
+
+    # orders still open can fill more, the next sync starts again at the first of them
+    openOrderIds = [
+        order["orderId"]
+        for order in orders
+        if order["status"] in ["NEW", "PARTIALLY_FILLED", "PENDING_NEW"]
     ]
-    df[["executedQty", "cummulativeQuoteQty", "price"]] = df[
-        ["executedQty", "cummulativeQuoteQty", "price"]
-    ].apply(pd.to_numeric)
-    df = df[df["executedQty"] > 0]
-    df.reset_index(inplace=True, drop=True)
-    df.to_json(f"./portfolio-data/history/{symbol}.json")
+    if len(openOrderIds):
+        nextOrderId = min(openOrderIds)
+    elif len(orders):
+        nextOrderId = orders[-1]["orderId"] + 1
+    with db:
+        db.executemany(
+            "INSERT OR REPLACE INTO orders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    symbol,
+                    order["orderId"],
+                    order["status"],
+                    float(order["executedQty"]),
+                    float(order["cummulativeQuoteQty"]),
+                    order["side"],
+                    order["updateTime"],
+                    order["time"],
+                    float(order["price"]),
+                )
+                for order in orders
+            ],
+        )
+        db.execute("INSERT OR REPLACE INTO syncs VALUES (?, ?)", (symbol, nextOrderId))
+
+    df = pd.read_sql_query(
+        """SELECT executedQty, cummulativeQuoteQty, side, updateTime, time, price
+        FROM orders WHERE symbol = ? AND executedQty > 0 ORDER BY time, orderId""",
+        db,
+        params=(symbol,),
+    )
+    db.close()
     return df
 
 
-def mainX():
-    # t = client.get_server_time()["serverTime"] // 1000
-    # print(t, datetime.utcfromtimestamp(int(t)))
-    # t = time.time()
-    # print(int(t), datetime.utcfromtimestamp(int(t)))
+def getTradedSymbols():
+    """Symbols held now, synced before or with a legacy history file"""
+    symbols = set(getBalances()["asset"])
+    db = getHistoryDB()
+    symbols.update(symbol for symbol, in db.execute("SELECT symbol FROM syncs"))
+    db.close()
+    if os.path.isdir("./portfolio-data/history"):
+        symbols.update(
+            name[: -len(".json")]
+            for name in os.listdir("./portfolio-data/history")
+            if name.endswith(".json")
+        )
+    return sorted(symbols - {"USDT", *extraRows})
 
-    orders = getAllOrders("SAND")
 
-    with open("x.csv", "w") as f:
-        for i, order in orders.iterrows():
-            side = order["side"][0] + order["side"][1:].lower()
-            # price = getPriceAtTime("SAND", endTime=order["time"])
-            f.write(
-                f"{side},{order['price']},{order['executedQty']},{order['cummulativeQuoteQty']}\n"
-            )
+def syncAllOrders(workers=8):
+    symbols = getTradedSymbols()
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(getAllOrders, symbol): symbol for symbol in symbols}
+        for future in tqdm(
+            as_completed(futures), total=len(futures), desc="Orders", disable=None
+        ):
+            try:
+                future.result()
+            except Exception as e:
+                failed.append(futures[future])
+                log(f"{futures[future]} {e}", error=True)
+    log(f"Synced orders of {len(symbols) - len(failed)} / {len(symbols)} symbols")
+
+
+def getSyncedOrders():
+    """Filled orders of every synced symbol, as getAllOrders returns them"""
+    db = getHistoryDB()
+    orders = pd.read_sql_query(
+        """SELECT symbol, executedQty, cummulativeQuoteQty, side, updateTime, time, price
+        FROM orders WHERE executedQty > 0 ORDER BY symbol, time, orderId""",
+        db,
+    )
+    db.close()
+    return {
+        symbol: df.drop(columns="symbol").reset_index(drop=True)
+        for symbol, df in orders.groupby("symbol", sort=False)
+    }
+
+
+def getCostBasis(orders, currentPrices=None):
+    """FIFO and average cost accounting of every symbol at once
+
+    orders maps symbols to getAllOrders frames. Fees are charged at tradefees
+    on both sides, buys include them in their cost and sells deduct them from
+    their proceeds. Sold amounts beyond what the orders bought came from
+    elsewhere, have no known cost and are left out as Unmatched.
+    """
+    columns = ["Held", "Unmatched", "Fees", "FIFO Cost", "Avg Cost"]
+    columns += ["FIFO Realized", "Avg Realized"]
+    if currentPrices is not None:
+        columns += ["FIFO Unrealized", "Avg Unrealized"]
+    if sum(len(symbolOrders) for symbolOrders in orders.values()) == 0:
+        return pd.DataFrame(columns=columns, dtype=float)
+    fills = pd.concat(orders, names=["symbol", None]).reset_index(level=0)
+    fills = fills.sort_values(["symbol", "time"], kind="stable").reset_index(drop=True)
+    symbols = fills["symbol"]
+    codes = pd.factorize(symbols)[0]
+    buys = fills["side"] == "BUY"
+    qty = fills["executedQty"]
+    fees = fills["cummulativeQuoteQty"] * tradefees
+    cost = (fills["cummulativeQuoteQty"] + fees).where(buys, 0)
+    proceeds = (fills["cummulativeQuoteQty"] - fees).where(~buys, 0)
+
+    bought = qty.where(buys, 0).groupby(symbols).cumsum()
+    sold = qty.where(~buys, 0).groupby(symbols).cumsum()
+    # sells take from the lots bought before them, the rest is unmatched
+    matched = sold + np.minimum(0, (bought - sold).groupby(symbols).cummin())
+    matchedQty = matched.groupby(symbols).diff().fillna(matched)
+    matchedProceeds = proceeds * (matchedQty / qty)
+
+    # FIFO: the cost of the first n coins bought is a piecewise linear function
+    # of n, each symbol gets its own [2 * code, 2 * code + 1] stretch of one axis
+    scale = bought.groupby(symbols).transform("last").replace(0, 1)
+    spent = cost.groupby(symbols).cumsum()
+    starts = 2 * np.unique(codes)
+    xp = np.concatenate([starts, 2 * codes[buys] + bought[buys] / scale[buys]])
+    fp = np.concatenate([np.zeros(len(starts)), spent[buys]])
+    order = np.argsort(xp, kind="stable")
+    matchedCost = pd.Series(
+        np.interp(2 * codes + matched / scale, xp[order], fp[order])
+    )
+    fifoCost = matchedCost.groupby(symbols).diff().fillna(matchedCost)
+
+    # average cost: the pool shrinks by the sold fraction of the held amount
+    # and restarts from zero whenever everything is sold
+    held = bought - matched.groupby(symbols).shift(fill_value=0)
+    kept = (1 - matchedQty / held.replace(0, np.inf)).where(~buys, 1)
+    closed = kept <= 1e-12
+    pools = [symbols, closed.groupby(symbols).cumsum()]
+    # the pool is the costs scaled by what's left of them, exp(decay - decay_j).
+    # Sells leaving dust decay it without bound, so each block of 600 nats is
+    # scaled on its own and the blocks carry the pool over one after another
+    decay = np.log(kept.where(~closed, 1)).groupby(pools).cumsum()
+    block = -decay // 600
+    blocks = [*pools, block]
+    factor = np.exp(decay + 600 * block)
+    pool = factor * (cost / factor).groupby(blocks).cumsum()
+    blockIds = pool.groupby(blocks).ngroup().to_numpy()
+    ends = pd.DataFrame({"pool": pool, "decay": decay}).groupby(blocks).last()
+    samePool = ends.index.droplevel(2).duplicated()
+    carryIn = np.zeros(len(ends))
+    carryDecay = np.zeros(len(ends))
+    for i in np.flatnonzero(samePool):
+        carryDecay[i] = ends["decay"].iat[i - 1]
+        carryIn[i] = ends["pool"].iat[i - 1] + carryIn[i - 1] * np.exp(
+            carryDecay[i] - carryDecay[i - 1]
+        )
+    pool += carryIn[blockIds] * np.exp(decay - carryDecay[blockIds])
+    avgCost = (pool.groupby(symbols).shift(fill_value=0) - pool).where(~buys, 0)
+
+    accounts = pd.DataFrame(
+        {
+            "Held": (bought - matched).groupby(symbols).last(),
+            "Unmatched": (sold - matched).groupby(symbols).last(),
+            "Fees": fees.groupby(symbols).sum(),
+            "FIFO Cost": (spent - matchedCost).groupby(symbols).last(),
+            "Avg Cost": pool.groupby(symbols).last(),
+            "FIFO Realized": (matchedProceeds - fifoCost).groupby(symbols).sum(),
+            "Avg Realized": (matchedProceeds - avgCost).groupby(symbols).sum(),
+        }
+    )
+    if currentPrices is not None:
+        value = accounts["Held"] * accounts.index.map(currentPrices)
+        accounts["FIFO Unrealized"] = value - accounts["FIFO Cost"]
+        accounts["Avg Unrealized"] = value - accounts["Avg Cost"]
+    accounts.loc["Total"] = accounts.sum()
+    accounts.loc["Total", ["Held", "Unmatched"]] = math.nan
+    return accounts
 
 
 if __name__ == "__main__":
-    main()
+    archive.configure()
+    metrics.configure()
+    syncOrders = False
+    pnl = False
+    workers = 8
+    equity = None
+    start = None
+    end = None
+    for arg in sys.argv[1:]:
+        if not arg.startswith("--"):
+            raise KeyError("Unknown option")
+        key, _, val = arg[2:].partition("=")
+        if key == "sync-orders":
+            syncOrders = True
+        elif key == "pnl":
+            pnl = True
+        elif key == "workers":
+            workers = int(val)
+        elif key == "equity":
+            equity = val or "1d"
+        elif key == "from":
+            start = val
+        elif key == "to":
+            end = val
+        else:
+            raise KeyError(f"Unknown option '{arg}'")
+
+    if syncOrders:
+        syncAllOrders(workers)
+    if pnl:
+        orders = getSyncedOrders()
+        fullPrint(getCostBasis(orders, getCurrentPrices(orders.keys())))
+    elif equity:
+        fullPrint(getEquityCurve(start, end, equity))
+    elif not syncOrders:
+        main()
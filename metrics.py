@@ -0,0 +1,176 @@
+import atexit
+import bisect
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import numpy as np
+
+enabled = False
+textfilePath = None
+buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+# latencies kept per endpoint for percentiles, a uniform sample past this
+sampleSize = 1000
+# per (service, endpoint): latency histogram, sample and counters
+latencies = defaultdict(
+    lambda: {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(buckets)}
+)
+samples = defaultdict(list)
+retries = defaultdict(int)
+errors = defaultdict(int)
+received = defaultdict(int)
+usedWeight = defaultdict(int)
+lock = threading.Lock()
+local = threading.local()
+
+
+def configure():
+    """Takes --metrics[=textfile] out of sys.argv, the summary is printed at
+    exit and the Prometheus textfile, if given, written with it"""
+    global enabled, textfilePath
+    args = []
+    for arg in sys.argv[1:]:
+        key, _, val = arg[2:].partition("=")
+        if arg.startswith("--") and key == "metrics":
+            enabled = True
+            textfilePath = val or None
+        else:
+            args.append(arg)
+    sys.argv[1:] = args
+    if enabled:
+        atexit.register(report)
+
+
+def getEndpoint(url):
+    """URL path with ids collapsed, so bots/123/update is one endpoint"""
+    return re.sub(r"/\d+(?=/|$)", "/{id}", urlparse(url).path)
+
+
+def observe(service):
+    """requests response hook recording one response of service"""
+
+    def hook(response, *args, **kwargs):
+        start = time.perf_counter()
+        size = len(response.content)
+        seconds = response.elapsed.total_seconds() + time.perf_counter() - start
+        key = (service, getEndpoint(response.url))
+        retried = int(getattr(local, "retry", False))
+        if response.raw is not None and getattr(response.raw, "retries", None):
+            retried += len(response.raw.retries.history)
+        weight = response.headers.get("X-MBX-USED-WEIGHT-1M")
+        weight = response.headers.get("X-MBX-USED-WEIGHT", weight)
+        with lock:
+            latency = latencies[key]
+            latency["count"] += 1
+            latency["sum"] += seconds
+            latency["max"] = max(latency["max"], seconds)
+            for i in range(bisect.bisect_left(buckets, seconds), len(buckets)):
+                latency["buckets"][i] += 1
+            # reservoir sampling keeps every latency equally likely to stay
+            if len(samples[key]) < sampleSize:
+                samples[key].append(seconds)
+            else:
+                i = random.randrange(latency["count"])
+                if i < sampleSize:
+                    samples[key][i] = seconds
+            retries[key] += retried
+            errors[key] += response.status_code >= 400
+            received[key] += size
+            if weight is not None:
+                usedWeight[key] = max(usedWeight[key], int(weight))
+        return response
+
+    return hook
+
+
+def instrument(service, client):
+    """client with every HTTP response of its session recorded, when enabled"""
+    if enabled:
+        client.session.hooks["response"].append(observe(service))
+    return client
+
+
+def setRetry(retry):
+    """Marks this thread's next calls as retries of an earlier one"""
+    local.retry = retry
+
+
+def getSummary():
+    """Table of calls, retries, errors, bytes, latency and weight per endpoint"""
+    lines = [
+        f"{'':9} {'endpoint':34} {'calls':>6} {'retry':>6} {'error':>6} {'MB':>7}"
+        f" {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'weight':>7}"
+    ]
+    with lock:
+        for (service, endpoint), latency in sorted(latencies.items()):
+            key = (service, endpoint)
+            p50, p95 = np.percentile(samples[key], [50, 95]) * 1000
+            lines.append(
+                f"{service:9} {endpoint:34} {latency['count']:>6} {retries[key]:>6}"
+                f" {errors[key]:>6} {received[key] / 2**20:>7.2f} {p50:>8.0f}"
+                f" {p95:>8.0f} {latency['max'] * 1000:>8.0f}"
+                f" {usedWeight.get(key, ''):>7}"
+            )
+    return "\n".join(lines)
+
+
+def getTextfile():
+    """Metrics in the Prometheus text format"""
+    lines = [
+        "# HELP api_request_duration_seconds Latency of outbound API requests.",
+        "# TYPE api_request_duration_seconds histogram",
+    ]
+    counters = []
+    with lock:
+        for (service, endpoint), latency in sorted(latencies.items()):
+            labels = f'service="{service}",endpoint="{endpoint}"'
+            for bucket, count in zip(buckets, latency["buckets"]):
+                lines.append(
+                    f'api_request_duration_seconds_bucket{{{labels},le="{bucket}"}}'
+                    f" {count}"
+                )
+            lines.append(
+                f'api_request_duration_seconds_bucket{{{labels},le="+Inf"}} '
+                f"{latency['count']}"
+            )
+            lines.append(
+                f"api_request_duration_seconds_sum{{{labels}}} {latency['sum']}"
+            )
+            lines.append(
+                f"api_request_duration_seconds_count{{{labels}}} {latency['count']}"
+            )
+            key = (service, endpoint)
+            counters.append((labels, retries[key], errors[key], received[key]))
+            if key in usedWeight:
+                counters[-1] += (usedWeight[key],)
+    for name, kind, description, column in [
+        ("api_request_retries_total", "counter", "Retried API requests.", 1),
+        ("api_request_errors_total", "counter", "API responses over 400.", 2),
+        ("api_response_bytes_total", "counter", "API response body bytes.", 3),
+        ("binance_used_weight", "gauge", "Highest X-MBX-USED-WEIGHT seen.", 4),
+    ]:
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+        lines += [
+            f"{name}{{{row[0]}}} {row[column]}" for row in counters if len(row) > column
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def write():
+    """Writes the textfile atomically, the node exporter may read it any time"""
+    if textfilePath is None:
+        return
+    os.makedirs(os.path.dirname(textfilePath) or ".", exist_ok=True)
+    with open(textfilePath + ".tmp", "w") as f:
+        f.write(getTextfile())
+    os.replace(textfilePath + ".tmp", textfilePath)
+
+
+def report():
+    print(getSummary(), file=sys.stderr)
+    write()